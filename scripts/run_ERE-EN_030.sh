@@ -88,6 +88,7 @@ python main.py \
     # --model_name_or_path "PATH TO THE CHECKPOINT" \ # configure the checkpoint path to eval
 
     # --load_path_cache \
+    # --token_cache "../cache/tokens" \ # reuse the tokenized datasets, the roles of the prompts then being shuffled per seed and split
     # --single_view_type $SVP_TYPE \
     # --load_ckpt_name "ckpt path" \
     # > $OUT_DIR/train.log 2>&1&
@@ -254,12 +254,6 @@ wikievent_event_description_dict = {
 }
 
 
-try:
-    with open("force_tokens.json", 'r') as f:
-        force_tokens = json.load(f)
-except:
-    print("目前还没有force_tokens.json文件！！！")
-
 
 cate_list = {
     "ACE05_EN_EAE": ACE05_argument_role_list,
@@ -0,0 +1,673 @@
+import torch
+from transformers.generation_logits_process import LogitsProcessor
+
+from const import force_words_eae, ere_event_type_argument_role_dict
+
+
+# sentencepiece pieces the target markers are made of, by name
+TO_PIECES = {
+    'T': ['T'],  # TriggeR
+    'A': ['A'],  # ArgumenT
+    'R': ['R'],  # Argument Role
+    'SS': ['SS'],
+    'EP': ['EP'],  # [SSEP]
+    '[': ['▁['],
+    ']': [']'],
+    'it': ['▁it'],
+    'null': ['▁nu', 'll'],
+}
+EOS_ID = 1
+SPACE_ID = 3  # '▁'
+# arguments of one role that max_target_lengths leaves room for
+ROLE_ARGUMENTS = 3
+
+
+def marker_token_ids(tokenizer):
+    """
+    Ids of the marker pieces in `tokenizer` by name, e.g. {'[': [784], ...}
+    with t5's vocabulary, the ids of a trimmed vocabulary differing. Pad,
+    EOS, unk and '▁' come first in every vocabulary and keep their ids.
+    """
+    token_ids = {}
+    for name, pieces in TO_PIECES.items():
+        ids = tokenizer.convert_tokens_to_ids(pieces)
+        if tokenizer.unk_token_id in ids:
+            raise ValueError(f"Tokenizer has no {pieces} pieces")
+        token_ids[name] = ids
+    return token_ids
+
+# grammar states, decided from the last emitted token and the bracket structure
+STATE_MARKER_OPEN = 0  # just emitted '[': a marker name follows
+STATE_MARKER_NAME = 1  # just emitted T / A / R / EP: close with ']'
+STATE_SS = 2  # just emitted SS: EP follows
+STATE_START = 3  # no '[' emitted yet
+STATE_UNCLOSED = 4  # inside an unclosed marker
+STATE_SEGMENT = 5  # inside the content of the last marker
+
+
+class ConstraintEngine:
+    """
+    Token tables and grammar automaton for constrained decoding, built once
+    per (task, dataset, tokenizer) and shared by every decoding step
+    """
+
+    def __init__(self, tokenizer, task, data_name, tries=True, template=False):
+        self.task = task
+        self.data_name = data_name
+        self.tries = tries
+        self.template = template
+        self.token_ids = marker_token_ids(tokenizer)
+
+        self.role_tokens = self._tokenize(tokenizer,
+                                          force_words_eae[task][data_name])
+        special_tokens = self._tokenize(tokenizer, ['[T', '[A', '[R', '[SS'])
+        self.special_tokens = [
+            r for r in special_tokens if r != self.token_ids['['][0]
+        ]
+        self._vocab_masks = {}
+
+        self.role_trie = TokenTrie()
+        self.role_root = self.role_trie.add_root([
+            self._tokenize(tokenizer, [w], eos=False)
+            for w in force_words_eae[task][data_name]
+        ])
+        self.event_type_roots = {
+            event_type: self.role_trie.add_root([
+                self._tokenize(tokenizer, [w], eos=False) for w in roles
+            ])
+            for event_type, roles in ere_event_type_argument_role_dict.items()
+        }
+
+    @staticmethod
+    def _tokenize(tokenizer, words, eos=True):
+        ids = []
+        for w in words:
+            w_ids = tokenizer(w)['input_ids']
+            if not eos and w_ids[-1:] == [EOS_ID]:
+                w_ids = w_ids[:-1]
+            ids.extend(w_ids)
+        return ids
+
+    def vocab_masks(self, vocab_size, device):
+        """
+        Vocabulary bitmaps of the ontology token sets, cached per device
+        """
+        key = (vocab_size, str(device))
+        if key not in self._vocab_masks:
+
+            def _mask(ids):
+                mask = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+                mask[ids] = True
+                return mask
+
+            self._vocab_masks[key] = {
+                'special': _mask(self.special_tokens),
+                'role': _mask(self.role_tokens),
+                'ss': _mask([SPACE_ID] + self.token_ids[']'] + [EOS_ID]),
+                'null': _mask(self.token_ids['null']),
+                ']': _mask(self.token_ids[']']),
+                'EP': _mask(self.token_ids['EP']),
+                'end': _mask(self.token_ids['['] + [EOS_ID]),
+            }
+        return self._vocab_masks[key]
+
+    @staticmethod
+    def source_bitmap(source_ids, vocab_size):
+        """
+        Per-row vocabulary bitmap of the source tokens, (batch, vocab)
+        """
+        bitmap = torch.zeros(source_ids.size(0),
+                             vocab_size,
+                             dtype=torch.bool,
+                             device=source_ids.device)
+        return bitmap.scatter_(1, source_ids, True)
+
+    def span_tables(self, source_ids):
+        """
+        Token table of the implicit trie over every contiguous source
+        subsequence, plus 'null', as (batch, positions) tokens with -1 at
+        breaks, and the positions a span may start and end at. Spans break
+        at padding and at the pieces of the prompt markers.
+        """
+        breaks = [0, EOS_ID] + self.token_ids['['] + self.token_ids[']'] + \
+            self.token_ids['EP'] + self.special_tokens
+        tokens = source_ids.masked_fill(
+            torch.isin(source_ids, source_ids.new_tensor(breaks)), -1)
+        null = source_ids.new_tensor([-1] + self.token_ids['null']).expand(
+            source_ids.size(0), -1)
+        tokens = torch.cat([tokens, null], dim=1)
+        start = tokens >= 0
+        end = start.clone()
+        start[:, -1] = False  # 'null' only as a whole
+        end[:, -2] = False
+        return tokens, start, end
+
+    @staticmethod
+    def template_tables(source_ids, token_ids):
+        """
+        Token table of the prompt after the sentence, which the target fills in, as (batch,
+        positions) tokens padded with -1: the prompt and EOS, plus a last
+        [SSEP] when the prompt ends with a role slot. `blank` marks the
+        positions an empty prompt slot is filled before, `jump` the slot
+        start a position may also go back to, since a role slot is repeated
+        once per argument of its role. Rows without a prompt get no table.
+        `token_ids` are the marker ids of marker_token_ids.
+        """
+        ssep = token_ids['['] + token_ids['SS'] + token_ids['EP'] + token_ids[']']
+        markers = token_ids['T'] + token_ids['A'] + token_ids['R']
+        role_marker = token_ids['['] + token_ids['R'] + token_ids[']']
+
+        def _is_marker(ids, i):
+            return (ids[i] == token_ids['['][0] and ids[i + 1] in markers
+                    and ids[i + 2] == token_ids[']'][0])
+
+        def _is_trigger_end(ids, i):
+            # '[/T]' closing the trigger marked in the sentence
+            return (ids[i] == token_ids['['][0] and ids[i + 2] == token_ids['T'][0]
+                    and ids[i + 3] == token_ids[']'][0])
+
+        rows = []
+        for ids in source_ids.tolist():
+            if EOS_ID in ids:
+                ids = ids[:ids.index(EOS_ID)]
+            sentence_end = max(
+                [i + 4 for i in range(len(ids) - 3) if _is_trigger_end(ids, i)],
+                default=0)
+            start = next((i for i in range(sentence_end, len(ids) - 2)
+                          if _is_marker(ids, i)), None)
+            if start is None:
+                rows.append(([], [], []))
+                continue
+            tokens = ids[start:] + [EOS_ID]
+            blank = [
+                p >= 3 and _is_marker(tokens, p - 3)
+                and tokens[p] in token_ids['['] + [EOS_ID]
+                for p in range(len(tokens))
+            ]
+            starts = [0] + [
+                p + len(ssep) for p in range(len(tokens))
+                if tokens[p:p + len(ssep)] == ssep
+            ]
+            ends = starts[1:] + [len(tokens)]
+            is_role = [
+                any(tokens[p:p + 3] == role_marker for p in range(b, e))
+                for b, e in zip(starts, ends)
+            ]
+            jump = [-1] * len(tokens)
+            for k in range(len(starts) - 1):
+                if is_role[k]:
+                    jump[starts[k + 1]] = starts[k]
+            if is_role[-1]:
+                jump[-1] = len(tokens)
+                tokens = tokens + ssep + [-1]
+                blank = blank + [False] * (len(ssep) + 1)
+                jump = jump + [-1] * len(ssep) + [starts[-1]]
+            rows.append((tokens, blank, jump))
+
+        width = max(len(tokens) for tokens, _, _ in rows) or 1
+
+        def _pad(values, fill, dtype):
+            return torch.tensor(
+                [row + [fill] * (width - len(row)) for row in values],
+                dtype=dtype,
+                device=source_ids.device)
+
+        tokens, blank, jump = zip(*rows)
+        return (_pad(tokens, -1, torch.long), _pad(blank, False, torch.bool),
+                _pad(jump, -1, torch.long))
+
+    def allowed_mask(self, decoder_state, source_bitmap):
+        """
+        Allowed-token mask (rows, vocab) for a batch of decoder states,
+        `source_bitmap` holding the source bitmap of each row
+        """
+        allowed = self.grammar_mask(decoder_state, source_bitmap)
+        if decoder_state.template_table is None:
+            return allowed
+        # the prompt only narrows the grammar, never empties a row
+        restricted = allowed & decoder_state.template_continuations(
+            source_bitmap.size(1))
+        return torch.where(restricted.any(1, keepdim=True), restricted,
+                           allowed)
+
+    def grammar_mask(self, decoder_state, source_bitmap):
+        """
+        Allowed-token mask of the target grammar alone
+        """
+        masks = self.vocab_masks(source_bitmap.size(1), source_bitmap.device)
+        state = decoder_state.grammar_state()
+        term, depth = decoder_state.term, decoder_state.depth
+
+        def _rows(cond):
+            return cond.unsqueeze(1)
+
+        allowed = _rows(state == STATE_MARKER_OPEN) & masks['special']
+        allowed |= _rows((state == STATE_MARKER_NAME)
+                         | (state == STATE_UNCLOSED)) & masks[']']
+        allowed |= _rows(state == STATE_SS) & masks['EP']
+        allowed |= _rows(state == STATE_START) & masks['end']
+
+        segment = state == STATE_SEGMENT
+        if not segment.any():
+            return allowed
+        is_copy = (term == self.token_ids['T'][0]) | (term == self.token_ids['A'][0])
+        is_role = term == self.token_ids['R'][0]
+        is_ss = term == self.token_ids['SS'][0]
+        invalid = segment & ~(is_copy | is_role | is_ss)
+        if invalid.any():
+            raise ValueError(term[invalid][0].item())
+        if (segment & (depth < 0)).any():
+            raise ValueError
+
+        if self.tries:
+            copy_content, copy_end = decoder_state.span_continuations(
+                source_bitmap.size(1))
+            role_content, role_end = decoder_state.role_continuations(
+                source_bitmap.size(1))
+            can_end = is_ss | (is_copy & copy_end) | (is_role & role_end)
+        else:
+            copy_content = source_bitmap | masks['null']
+            role_content = masks['role']
+            can_end = segment
+        content = _rows(segment & is_copy) & copy_content
+        content |= _rows(segment & is_role) & role_content
+        content |= _rows(segment & is_ss) & masks['ss']
+        closed = content & ~(masks[']'] | masks['special'])
+        allowed |= _rows(segment & (depth == 0)) & closed
+        allowed |= _rows(segment & (depth > 0)) & (content | masks[']'])
+        allowed |= _rows(segment & can_end) & masks['end']
+        return allowed
+
+    def role_roots(self, event_types, device):
+        """
+        Role trie root of each example: the roles of its event type, or every
+        role of the dataset when the type is unknown
+        """
+        if event_types is None:
+            roots = [self.role_root]
+        else:
+            roots = [
+                self.event_type_roots.get(t, self.role_root)
+                for t in event_types
+            ]
+        return torch.tensor(roots, dtype=torch.long, device=device)
+
+    def logits_processor(self, source_ids, event_types=None):
+        """
+        Build the batched constrained-decoding logits processor for a batch,
+        `event_types` restricting the roles of each example
+        """
+        return ConstrainedLogitsProcessor(self, source_ids, event_types)
+
+
+def max_target_lengths(source_ids, token_ids, max_slot_length, max_length, source_max_length=None):
+    """
+    Cap on the target length of each input, decoder start and EOS included:
+    its prompt with every slot filled with up to `max_slot_length` tokens and
+    every role slot repeated for up to ROLE_ARGUMENTS arguments, at most
+    `max_length`. Targets beyond these allowances exceed it. Inputs without
+    a prompt, or whose prompt may have been cut off (no EOS, or
+    `source_max_length` tokens), get `max_length`.
+    """
+    template_table, template_blank, template_jump = ConstraintEngine.template_tables(source_ids, token_ids)
+    prompt_lengths = (template_table == EOS_ID).int().argmax(dim=1)
+    bounds = 2 + prompt_lengths + template_blank.sum(dim=1) * max_slot_length
+    # a role slot jumps back to its start for each further argument, through a [SSEP]
+    positions = torch.arange(template_jump.size(1), device=template_jump.device)
+    repeats = (template_jump >= 0) & (template_jump < positions)
+    blanks = torch.cat([torch.zeros_like(template_blank[:, :1], dtype=torch.long),
+                        template_blank.long().cumsum(dim=1)], dim=1)
+    starts = template_jump.clamp(min=0)
+    repeat_lengths = positions - starts + (blanks[:, :-1] - blanks.gather(1, starts)) * max_slot_length
+    bounds += (ROLE_ARGUMENTS - 1) * (repeat_lengths * repeats).sum(dim=1)
+    truncated = ~(source_ids == EOS_ID).any(dim=1)
+    if source_max_length is not None:
+        truncated |= (source_ids != 0).sum(dim=1) >= source_max_length
+    bounds[truncated | ~(template_table == EOS_ID).any(dim=1)] = max_length
+    return bounds.clamp(max=max_length)
+
+
+class TokenTrie:
+    """
+    Prefix trie over token sequences, stored as flat edge tensors so that a
+    whole batch of hypotheses can be stepped at once. Node -1 is a dead end.
+    """
+
+    def __init__(self):
+        self._children = []
+        self._terminal = []
+        self._tensors = {}
+
+    def _new_node(self):
+        self._children.append({})
+        self._terminal.append(False)
+        return len(self._children) - 1
+
+    def add_root(self, sequences):
+        """
+        Add a trie over `sequences` and return its root node
+        """
+        root = self._new_node()
+        for seq in sequences:
+            node = root
+            for token in seq:
+                if token not in self._children[node]:
+                    self._children[node][token] = self._new_node()
+                node = self._children[node][token]
+            self._terminal[node] = True
+        self._tensors = {}
+        return root
+
+    def tensors(self, device):
+        key = str(device)
+        if key not in self._tensors:
+            edges = [(parent, token, child)
+                     for parent, children in enumerate(self._children)
+                     for token, child in children.items()]
+            parent, token, child = zip(*edges) if edges else ((), (), ())
+            self._tensors[key] = (
+                torch.tensor(parent, dtype=torch.long, device=device),
+                torch.tensor(token, dtype=torch.long, device=device),
+                torch.tensor(child, dtype=torch.long, device=device),
+                torch.tensor(self._terminal, dtype=torch.bool, device=device),
+            )
+        return self._tensors[key]
+
+    def step(self, nodes, tokens):
+        parent, token, child = self.tensors(nodes.device)[:3]
+        hit = (parent == nodes.unsqueeze(1)) & (token == tokens.unsqueeze(1))
+        return torch.where(hit.any(1), (hit * child).sum(1),
+                           torch.full_like(nodes, -1))
+
+    def continuations(self, nodes, vocab_size):
+        """
+        Allowed-token mask of the children of `nodes`, and whether each node
+        ends a sequence (dead ends may end, so decoding can recover)
+        """
+        parent, token, _, terminal = self.tensors(nodes.device)
+        hit = parent == nodes.unsqueeze(1)
+        index = torch.where(hit, token, torch.full_like(token, vocab_size))
+        mask = torch.zeros(nodes.size(0),
+                           vocab_size + 1,
+                           dtype=torch.bool,
+                           device=nodes.device)
+        mask.scatter_(1, index, True)
+        ends = torch.where(nodes >= 0, terminal[nodes.clamp(min=0)],
+                           torch.ones_like(nodes, dtype=torch.bool))
+        return mask[:, :vocab_size], ends
+
+
+class DecoderState:
+    """
+    Incremental grammar state of every hypothesis: last token, open bracket
+    depth, marker of the current segment and position inside that segment.
+    Each step only reads the newly emitted tokens.
+    """
+
+    _fields = ('example_ids', 'last', 'depth', 'term', 'is_open', 'seen',
+               'span_pos', 'span_match', 'role_node', 'template_match')
+
+    def __init__(self,
+                 example_ids,
+                 token_ids,
+                 span_table=None,
+                 span_start=None,
+                 span_end=None,
+                 role_trie=None,
+                 role_roots=None,
+                 template_table=None,
+                 template_blank=None,
+                 template_jump=None):
+        self.example_ids = example_ids
+        self.token_ids = token_ids
+        # per-example tables, rows reach them through `example_ids`
+        self.span_table = span_table
+        self.span_start = span_start
+        self.span_end = span_end
+        self.role_trie = role_trie
+        self.role_roots = role_roots
+        self.last = torch.full_like(example_ids, -1)
+        self.depth = torch.zeros_like(example_ids)
+        self.term = torch.full_like(example_ids, -1)
+        self.is_open = torch.zeros_like(example_ids, dtype=torch.bool)
+        self.seen = torch.zeros_like(example_ids, dtype=torch.bool)
+        self.span_pos = torch.zeros_like(example_ids)
+        # source positions the current span ends at
+        self.span_match = None if span_table is None else torch.zeros(
+            example_ids.size(0),
+            span_table.size(1),
+            dtype=torch.bool,
+            device=example_ids.device)
+        self.role_node = torch.full_like(example_ids, -1)
+        self.template_table = template_table
+        self.template_blank = template_blank
+        self.template_jump = template_jump
+        # prompt positions the target may be at
+        self.template_match = None
+        if template_table is not None:
+            self.template_match = torch.zeros(example_ids.size(0),
+                                              template_table.size(1),
+                                              dtype=torch.bool,
+                                              device=example_ids.device)
+            self.template_match[:, 0] = template_table[example_ids, 0] >= 0
+        self.length = 0
+
+    @classmethod
+    def from_prefix(cls, input_ids, example_ids, **tables):
+        decoder_state = cls(example_ids, **tables)
+        for i in range(input_ids.size(1)):
+            decoder_state.advance(input_ids[:, i])
+        return decoder_state
+
+    def follows(self, input_ids):
+        """
+        Whether `input_ids` is the tracked prefix plus one new token per row
+        """
+        return (input_ids.size(0) == self.last.size(0)
+                and input_ids.size(1) == self.length + 1
+                and torch.equal(input_ids[:, -2], self.last))
+
+    def advance(self, tokens, rows=None):
+        """
+        Read the next token of every row, leaving the rows outside `rows`
+        untouched when given
+        """
+        if rows is not None:
+            previous = {name: getattr(self, name) for name in self._fields}
+        if self.template_match is not None and self.length > 0:
+            self._advance_template(tokens)
+        first = (self.span_pos == 0).unsqueeze(1)
+        if self.span_table is not None:
+            hit = self.span_table[self.example_ids] == tokens.unsqueeze(1)
+            follows = torch.zeros_like(self.span_match)
+            follows[:, 1:] = self.span_match[:, :-1]
+            self.span_match = torch.where(
+                first, hit & self.span_start[self.example_ids], hit & follows)
+        if self.role_trie is not None:
+            nodes = torch.where(first.squeeze(1),
+                                self.role_roots[self.example_ids],
+                                self.role_node)
+            self.role_node = self.role_trie.step(nodes, tokens)
+
+        is_left = tokens == self.token_ids['['][0]
+        is_right = tokens == self.token_ids[']'][0]
+        self.term = torch.where(self.last == self.token_ids['['][0], tokens, self.term)
+        self.depth = self.depth + is_left.long() - is_right.long()
+        self.is_open = (self.is_open | is_left) & ~is_right
+        self.seen = self.seen | is_left
+        self.span_pos = torch.where(is_left | is_right,
+                                    torch.zeros_like(self.span_pos),
+                                    self.span_pos + 1)
+        self.last = tokens
+        self.length += 1
+
+        if rows is not None:
+            for name, value in previous.items():
+                if value is not None:
+                    keep = rows.view(-1, *[1] * (value.dim() - 1))
+                    setattr(self, name,
+                            torch.where(keep, getattr(self, name), value))
+
+    def _advance_template(self, tokens):
+        table = self.template_table[self.example_ids]
+        hit = self.template_match & (table == tokens.unsqueeze(1))
+        match = torch.zeros_like(hit)
+        match[:, 1:] = hit[:, :-1]
+        # anything but a marker or EOS fills the blank the row is at
+        filling = (tokens != self.token_ids['['][0]) & (tokens != EOS_ID)
+        match |= (self.template_match & self.template_blank[self.example_ids]
+                  & filling.unsqueeze(1))
+        jump = self.template_jump[self.example_ids]
+        index = torch.where(match & (jump >= 0), jump,
+                            torch.full_like(jump, jump.size(1)))
+        jumped = torch.zeros(jump.size(0),
+                             jump.size(1) + 1,
+                             dtype=torch.bool,
+                             device=jump.device)
+        jumped.scatter_(1, index, True)
+        self.template_match = match | jumped[:, :-1]
+
+    def reorder(self, index):
+        """
+        Follow the hypotheses when beam search reshuffles them
+        """
+        for name in self._fields:
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, value.index_select(0, index))
+
+    def span_continuations(self, vocab_size):
+        """
+        Tokens that extend the current span into a longer source span, and
+        whether the span may end here (a span off the source may always end,
+        so decoding can recover)
+        """
+        table = self.span_table[self.example_ids]
+        follows = torch.zeros_like(self.span_match)
+        follows[:, 1:] = self.span_match[:, :-1]
+        first = (self.span_pos == 0).unsqueeze(1)
+        positions = torch.where(first, self.span_start[self.example_ids],
+                                follows & (table >= 0))
+        index = torch.where(positions, table, torch.full_like(table, vocab_size))
+        mask = torch.zeros(table.size(0),
+                           vocab_size + 1,
+                           dtype=torch.bool,
+                           device=table.device)
+        mask.scatter_(1, index, True)
+        can_end = (self.span_match & self.span_end[self.example_ids]).any(1)
+        dead = ~self.span_match.any(1)
+        return mask[:, :vocab_size], (self.span_pos > 0) & (can_end | dead)
+
+    def role_continuations(self, vocab_size):
+        """
+        Tokens that extend the current role name, and whether it is complete
+        """
+        nodes = torch.where(self.span_pos == 0,
+                            self.role_roots[self.example_ids], self.role_node)
+        return self.role_trie.continuations(nodes, vocab_size)
+
+    def template_continuations(self, vocab_size):
+        """
+        Tokens the prompt allows next: its next token, any filling while a
+        blank is filled, anything once the target left the prompt
+        """
+        table = self.template_table[self.example_ids]
+        index = torch.where(self.template_match & (table >= 0), table,
+                            torch.full_like(table, vocab_size))
+        mask = torch.zeros(table.size(0),
+                           vocab_size + 1,
+                           dtype=torch.bool,
+                           device=table.device)
+        mask.scatter_(1, index, True)
+        mask = mask[:, :vocab_size]
+        filling = torch.ones_like(mask[0])
+        filling[self.token_ids['['] + [EOS_ID]] = False
+        blank = self.template_blank[self.example_ids]
+        mask |= (self.template_match & blank).any(1, keepdim=True) & filling
+        return mask | ~self.template_match.any(1, keepdim=True)
+
+    def grammar_state(self):
+        """
+        STATE_* of each tracked hypothesis, from its last token and whether a
+        bracket is open
+        """
+        state = torch.full_like(self.last, STATE_SEGMENT)
+        state[self.is_open] = STATE_UNCLOSED
+        state[~self.seen] = STATE_START
+        state[self.last == self.token_ids['SS'][0]] = STATE_SS
+        for name in ('T', 'A', 'R', 'EP'):
+            state[self.last == self.token_ids[name][0]] = STATE_MARKER_NAME
+        state[self.last == self.token_ids['['][0]] = STATE_MARKER_OPEN
+        return state
+
+
+class ConstrainedLogitsProcessor(LogitsProcessor):
+    """
+    Mask the scores of the whole (batch x beam) matrix at once, from per-row
+    bitmaps of the source tokens and the ontology token sets
+    """
+
+    def __init__(self, engine, source_ids, event_types=None):
+        self.engine = engine
+        self.source_ids = source_ids
+        self.source_bitmap = None
+        self.decoder_state = None
+        self.tables = {'token_ids': engine.token_ids}
+        if engine.tries:
+            span_table, span_start, span_end = engine.span_tables(source_ids)
+            self.tables.update({
+                'span_table': span_table,
+                'span_start': span_start,
+                'span_end': span_end,
+                'role_trie': engine.role_trie,
+                'role_roots': engine.role_roots(
+                    event_types, source_ids.device).expand(source_ids.size(0)),
+            })
+        if engine.template:
+            template_table, template_blank, template_jump = \
+                engine.template_tables(source_ids, engine.token_ids)
+            self.tables.update({
+                'template_table': template_table,
+                'template_blank': template_blank,
+                'template_jump': template_jump,
+            })
+
+    def reorder(self, beam_idx):
+        if self.decoder_state is not None:
+            self.decoder_state.reorder(beam_idx)
+
+    def advance(self, tokens, rows=None):
+        """
+        Feed the next token of each hypothesis (of `rows` only when given),
+        for decoding loops that grow the hypotheses unevenly
+        """
+        if self.decoder_state is None:
+            num_beams = tokens.size(0) // self.source_ids.size(0)
+            example_ids = torch.arange(tokens.size(0),
+                                       device=tokens.device) // num_beams
+            self.decoder_state = DecoderState(example_ids, **self.tables)
+        self.decoder_state.advance(tokens, rows)
+
+    def allowed(self, vocab_size):
+        """
+        Allowed-token mask of the tracked hypotheses
+        """
+        if self.source_bitmap is None:
+            self.source_bitmap = self.engine.source_bitmap(
+                self.source_ids.to(self.decoder_state.last.device), vocab_size)
+        return self.engine.allowed_mask(
+            self.decoder_state,
+            self.source_bitmap[self.decoder_state.example_ids])
+
+    def __call__(self, input_ids, scores):
+        if self.decoder_state is not None and self.decoder_state.follows(
+                input_ids):
+            self.decoder_state.advance(input_ids[:, -1])
+        else:
+            num_beams = input_ids.size(0) // self.source_ids.size(0)
+            example_ids = torch.arange(input_ids.size(0),
+                                       device=input_ids.device) // num_beams
+            self.decoder_state = DecoderState.from_prefix(
+                input_ids, example_ids, **self.tables)
+        allowed = self.allowed(scores.size(-1))
+        return scores.masked_fill(~allowed, -float("inf"))
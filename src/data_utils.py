@@ -1,14 +1,27 @@
 import random
+import itertools
 import json
+import os
+import hashlib
 import numpy as np
 from itertools import permutations
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
+from torch.utils.data.dataloader import default_collate
 
 from t5_score import MyT5ForConditionalGenerationScore
+from constrained_decoding import max_target_lengths, marker_token_ids
 from const import *
 import random
 
+# texts tokenized per batch_encode_plus call, and rows per max_target_lengths call
+TOKENIZE_BATCH_SIZE = 1024
+# bumped whenever the examples are built differently, invalidating the token caches
+TOKEN_CACHE_VERSION = 4
+CACHED_ARRAYS = ["source_ids", "source_lengths", "target_ids", "target_lengths", "event_index",
+                 "event_description_ids", "event_description_lengths", "max_lengths"]
+
+
 def get_element_tokens(task):
     dic = {
         "eae":
@@ -67,6 +80,29 @@ def read_line_examples_from_file(data_path,
                            {"head": 17, "tail": 18, "words": "Maine", "role": "Entity"}]}]}
 '''
 
+def parse_json_example(line, lowercase):
+    """
+    Words of the sentence of a parsed JSON line, with the trigger of its
+    first event marked by [T] [/T], and its events
+    """
+    words = line["sentence"]
+    events = line["events"]
+
+
+
+    if lowercase:
+        words = [word.lower() for word in words]
+        if events != []:
+            for i in range(len(events)):
+                events[i]["trigger"]["words"] = events[i]["trigger"]["words"].lower()
+                for j in range(len(events[i]["arguments"])):
+                    events[i]["arguments"][j]["words"] = events[i]["arguments"][j]["words"].lower()
+                    
+    words.insert(events[0]["trigger"]["start"], "[T]")
+    words.insert(events[0]["trigger"]["end"] + 1, "[/T]")
+    return words, events
+
+
 def read_line_examples_from_json_file(data_path,
                                  task_name,
                                  data_name,
@@ -85,21 +121,7 @@ def read_line_examples_from_json_file(data_path,
         words, labels = [], []
         for line in fp:
             line = json.loads(line)
-            words = line["sentence"]
-            events = line["events"]
-
-
-
-            if lowercase:
-                words = [word.lower() for word in words]
-                if events != []:
-                    for i in range(len(events)):
-                        events[i]["trigger"]["words"] = events[i]["trigger"]["words"].lower()
-                        for j in range(len(events[i]["arguments"])):
-                            events[i]["arguments"][j]["words"] = events[i]["arguments"][j]["words"].lower()
-                            
-            words.insert(events[0]["trigger"]["start"], "[T]")
-            words.insert(events[0]["trigger"]["end"] + 1, "[/T]")
+            words, events = parse_json_example(line, lowercase)
                         
 
             if "unified" in task_name:
@@ -158,14 +180,16 @@ def cal_entropy(inputs, preds, model_path, tokenizer, device=torch.device('cuda'
 
 
 
-def get_para_targets_eae(sents, labels, data_name, data_type, top_k, task, args):
+def get_para_targets_eae(sents, labels, data_name, data_type, top_k, task, args, rng=random):
     """
-    Obtain the target sentence under the paraphrase paradigm
+    Obtain the target sentence under the paraphrase paradigm, the roles of
+    each prompt shuffled by `rng`
     """
     targets = []
     new_sents = []
 
     event_descriptions = []
+    event_types = []
     top_k = min(10, top_k)    
     optim_orders = get_orders(task, data_name, args, sents, labels)[:top_k]
     
@@ -173,7 +197,8 @@ def get_para_targets_eae(sents, labels, data_name, data_type, top_k, task, args)
         label = labels[i] 
         cur_sent = sents[i]
         cur_sent_str = " ".join(cur_sent) 
-        event_description = ere_event_description_dict[label[0]["trigger"]["type"]]
+        event_type = label[0]["trigger"]["type"]
+        event_description = ere_event_description_dict[event_type]
 
         '''
         {"sentence": ["The", "call", "reflected", "the", "insistent", "demand", "made", "by", "the", "three", "leaders", "before", "the", 
@@ -197,7 +222,7 @@ def get_para_targets_eae(sents, labels, data_name, data_type, top_k, task, args)
 
                 element_event_all_arg_dict = {}
                 event_args = [event_arg for event_arg in ere_event_type_argument_role_dict[event["trigger"]["type"]]]
-                random.shuffle(event_args)
+                rng.shuffle(event_args)
 
                 if event["arguments"] != []:
                     
@@ -297,18 +322,21 @@ def get_para_targets_eae(sents, labels, data_name, data_type, top_k, task, args)
             new_sents.append((cur_sent_str + " " + sent_prompt_str).split(" "))
         
             event_descriptions.append(event_description)
+            event_types.append(event_type)
         
-    return new_sents, targets, event_descriptions
+    return new_sents, targets, event_descriptions, event_types
 
 
-def get_para_targets_eae_dev(sents, labels, data_name, task, args):
+def get_para_targets_eae_dev(sents, labels, data_name, task, args, rng=random):
     """
-    Obtain the target sentence under the paraphrase paradigm
+    Obtain the target sentence under the paraphrase paradigm, the roles of
+    each prompt shuffled by `rng`
     """
     targets = []
     new_sents = []
 
     event_descriptions = []
+    event_types = []
     optim_orders = get_orders(task, data_name, args, sents=None, labels=None)
     top_order = optim_orders[0] 
     
@@ -316,7 +344,8 @@ def get_para_targets_eae_dev(sents, labels, data_name, task, args):
         label = labels[i] 
         cur_sent = sents[i]
         cur_sent_str = " ".join(cur_sent) 
-        event_description = ere_event_description_dict[label[0]["trigger"]["type"]]
+        event_type = label[0]["trigger"]["type"]
+        event_description = ere_event_description_dict[event_type]
 
         '''
         {"sentence": ["The", "call", "reflected", "the", "insistent", "demand", "made", "by", "the", "three", "leaders", "before", "the", 
@@ -340,7 +369,7 @@ def get_para_targets_eae_dev(sents, labels, data_name, task, args):
 
                 element_event_all_arg_dict = {}
                 event_args = [event_arg for event_arg in ere_event_type_argument_role_dict[event["trigger"]["type"]]]
-                random.shuffle(event_args)
+                rng.shuffle(event_args)
 
 
                 if event["arguments"] != []:
@@ -434,8 +463,9 @@ def get_para_targets_eae_dev(sents, labels, data_name, task, args):
         new_sents.append((cur_sent_str + " " + sent_prompt_str).split(" "))
 
         event_descriptions.append(event_description)
+        event_types.append(event_type)
         
-    return new_sents, targets, event_descriptions
+    return new_sents, targets, event_descriptions, event_types
 
 
 
@@ -458,14 +488,14 @@ def get_transformed_io(data_path, data_name, data_type, top_k, args):
             print("Labels:", sample_labels)
 
     if data_type == "train" or args.eval_data_split == "dev" or data_type == "test":
-        new_inputs, targets, event_descriptions = get_para_targets_eae(inputs, labels, data_name,
+        new_inputs, targets, event_descriptions, event_types = get_para_targets_eae(inputs, labels, data_name,
                                                data_type, top_k, args.task,
                                                args)    
     else:
-        new_inputs, targets, event_descriptions = get_para_targets_eae_dev(inputs, labels, data_name,
+        new_inputs, targets, event_descriptions, event_types = get_para_targets_eae_dev(inputs, labels, data_name,
                                                    args.task, args)
     print(len(inputs), len(new_inputs), len(targets), len(event_descriptions))
-    return new_inputs, targets, event_descriptions
+    return new_inputs, targets, event_descriptions, event_types
 
 
 def get_transformed_io_unified(data_path, task_name, data_name, data_type,
@@ -516,81 +546,437 @@ class ABSADataset(Dataset):
 
         self.top_k = top_k
 
-        self.inputs = []
-        self.targets = []
-        self.event_descriptions = []
+        # test targets are only decoded back to text, so they are bounded
+        # by 1024 tokens rather than max_len
+        self.target_max_length = 1024 if data_type == "test" else max_len
+        # token ids as matrices padded to the longest row of each field, of
+        # uint16 when the vocabulary fits, with the real length of each row
+        self.id_dtype = np.uint16 if len(tokenizer) <= 1 << 16 else np.int32
+        self.source_ids = None
+        self.source_lengths = None
+        self.target_ids = None
+        self.target_lengths = None
+        # event types and descriptions are interned: one row per type,
+        # referenced by the event index of each example
+        self.event_types = []
+        self.event_index = None
+        self.event_description_ids = None
+        self.event_description_lengths = None
+        # cap of the target length of each example: from its prompt with
+        # --length_caps, max_len otherwise
+        self.max_lengths = None
 
         self._build_examples()
 
     def __len__(self):
-        return len(self.inputs)
+        return len(self.event_index)
 
-    def __getitem__(self, index):
-        source_ids = self.inputs[index]["input_ids"].squeeze()
-        target_ids = self.targets[index]["input_ids"].squeeze()
-
-        event_description_ids = self.event_descriptions[index]["input_ids"].squeeze()
-
-        src_mask = self.inputs[index]["attention_mask"].squeeze(
-        ) 
-        target_mask = self.targets[index]["attention_mask"].squeeze(
-        )
-    
-        event_description_mask = self.event_descriptions[index]["attention_mask"].squeeze(
-        ) 
+    @staticmethod
+    def _row(ids, lengths, index):
+        return torch.from_numpy(ids[index, :lengths[index]].astype(np.int64))
 
+    def __getitem__(self, index):
+        """
+        Unpadded ids of the example, pad_batch pads them and builds the masks
+        """
+        event = self.event_index[index]
         return {
-            "source_ids": source_ids,
-            "source_mask": src_mask,
-            "target_ids": target_ids,
-            "target_mask": target_mask,
-            "event_description_ids": event_description_ids,
-            "event_description_mask": event_description_mask,
+            "index": index,
+            "source_ids": self._row(self.source_ids, self.source_lengths, index),
+            "target_ids": self._row(self.target_ids, self.target_lengths, index),
+            "event_description_ids": self._row(
+                self.event_description_ids, self.event_description_lengths, event),
+            "event_type": self.event_types[event],
+            "max_length": int(self.max_lengths[index]),
         }
 
+    def _tokenize(self, texts, max_length):
+        """
+        Token ids of `texts`, truncated to `max_length` and padded to the
+        longest of them, and their lengths. Each distinct text is tokenized
+        once, in batches.
+        """
+        distinct = list(dict.fromkeys(texts))
+        ids = np.full((len(distinct), max_length), self.tokenizer.pad_token_id, dtype=self.id_dtype)
+        lengths = np.zeros(len(distinct), dtype=np.int32)
+        for start in range(0, len(distinct), TOKENIZE_BATCH_SIZE):
+            tokenized = self.tokenizer.batch_encode_plus(
+                distinct[start:start + TOKENIZE_BATCH_SIZE],
+                max_length=max_length,
+                padding=True,
+                truncation=True,
+                return_tensors="np")
+            width = tokenized["input_ids"].shape[1]
+            ids[start:start + TOKENIZE_BATCH_SIZE, :width] = tokenized["input_ids"]
+            lengths[start:start + TOKENIZE_BATCH_SIZE] = tokenized["attention_mask"].sum(axis=1)
+        ids = ids[:, :lengths.max(initial=0)]
+        if len(distinct) == len(texts):
+            return np.ascontiguousarray(ids), lengths
+        rows = {text: i for i, text in enumerate(distinct)}
+        index = np.array([rows[text] for text in texts], dtype=np.int64)
+        return ids[index], lengths[index]
+
+    def _cache_path(self):
+        """
+        Directory of the token cache for this dataset, named by a digest of
+        everything the examples depend on: the data file, the tokenizer, the
+        options building the views and the seed the roles of the prompts are
+        shuffled with
+        """
+        digest = hashlib.sha1()
+        for path in (self.data_path, self.tokenizer.vocab_file):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        digest.update(json.dumps([
+            TOKEN_CACHE_VERSION,
+            type(self.tokenizer).__name__,
+            sorted(self.tokenizer.get_added_vocab().items()),
+            self.data_type,
+            self.max_len,
+            self.top_k,
+            self.args.lowercase,
+            get_orders(self.args.task, self.data_name, self.args, None, None),
+            self.args.eval_data_split,
+            self.args.data_ratio,
+            self.args.max_slot_length,
+            self.args.length_caps,
+            self.args.seed,
+        ]).encode())
+        return os.path.join(self.args.token_cache,
+                            f"{self.data_name}_{self.data_type}_{digest.hexdigest()[:16]}")
+
+    def _save_examples(self, path):
+        """
+        Write the examples as .npy files, to a temporary directory renamed at
+        the end so that concurrent runs never read a partial cache
+        """
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        for name in CACHED_ARRAYS:
+            np.save(os.path.join(tmp_path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"event_types": self.event_types}, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another run saved the same cache first
+            for name in os.listdir(tmp_path):
+                os.remove(os.path.join(tmp_path, name))
+            os.rmdir(tmp_path)
+
+    def _load_examples(self, path):
+        """
+        Memory-map the examples saved by _save_examples
+        """
+        for name in CACHED_ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.event_types = meta["event_types"]
+        print(f"Loaded {len(self.event_index)} examples from {path}")
+
     def _build_examples(self):
+        cache_path = None
+        if self.args.token_cache:
+            cache_path = self._cache_path()
+            if os.path.isdir(cache_path):
+                self._load_examples(cache_path)
+                return
+            # the roles are shuffled from a state given by the seed and the
+            # split alone, so that the cached examples are those of any run
+            # with the same key, and `random` is left as loading them would
+            random_state = random.getstate()
+            random.seed(f"{self.args.seed}_{self.task_name}_{self.data_name}_{self.data_type}")
 
         if self.args.multi_task:
             inputs, targets = get_transformed_io_unified(
                 self.data_path, self.task_name, self.data_name, self.data_type,
                 self.top_k, self.args)
         else: 
-            inputs, targets, event_descriptions = get_transformed_io(self.data_path,
+            inputs, targets, event_descriptions, event_types = get_transformed_io(self.data_path,
                                                  self.data_name,
                                                  self.data_type, self.top_k,
                                                  self.args)
+        if cache_path is not None:
+            random.setstate(random_state)
+
+        self.source_ids, self.source_lengths = self._tokenize(
+            [' '.join(input) for input in inputs], self.max_len)
+        self.target_ids, self.target_lengths = self._tokenize(targets, self.target_max_length)
+        descriptions = dict(zip(event_types, event_descriptions))
+        self.event_types = list(descriptions)
+        rows = {event_type: i for i, event_type in enumerate(self.event_types)}
+        self.event_index = np.array([rows[event_type] for event_type in event_types], dtype=np.int32)
+        self.event_description_ids, self.event_description_lengths = self._tokenize(
+            list(descriptions.values()), 100)
+        if self.args.length_caps:
+            token_ids = marker_token_ids(self.tokenizer)
+            self.max_lengths = np.concatenate([
+                max_target_lengths(torch.from_numpy(self.source_ids[start:start + TOKENIZE_BATCH_SIZE].astype(np.int64)),
+                                   token_ids, self.args.max_slot_length, self.max_len,
+                                   source_max_length=self.max_len).numpy().astype(np.int32)
+                for start in range(0, len(self.source_ids), TOKENIZE_BATCH_SIZE)
+            ] or [np.zeros(0, dtype=np.int32)])
+        else:
+            self.max_lengths = np.full(len(self.source_ids), self.max_len, dtype=np.int32)
 
-        for i in range(len(inputs)):
-            input = ' '.join(inputs[i])
-            target = targets[i]
+        if cache_path is not None:
+            os.makedirs(self.args.token_cache, exist_ok=True)
+            self._save_examples(cache_path)
 
-            event_description = event_descriptions[i]
 
+class StreamingABSADataset(IterableDataset):
+    """
+    ABSADataset read lazily, for corpora too large to hold in memory: each
+    DataLoader worker of each rank reads its share of the lines of the JSONL
+    file and builds and tokenizes their views a chunk at a time. Training
+    examples go through a shuffle buffer of args.shuffle_buffer examples, so
+    memory does not grow with the corpus. The buffer and the roles of the
+    prompts are shuffled by a generator of each worker, seeded by the
+    DataLoader so that workers differ and runs repeat. Items are those of ABSADataset,
+    view v of line n having the index n * views + v, which evaluation
+    restores the order of the file by. The token cache does not apply.
+    """
 
-            tokenized_input = self.tokenizer.batch_encode_plus(
-                [input],
-                max_length=self.max_len,
-                padding="max_length",
-                truncation=True,
-                return_tensors="pt")  
-            target_max_length = 1024 if self.data_type == "test" else self.max_len
+    def __init__(self,
+                 tokenizer,
+                 task_name,
+                 data_name,
+                 data_type,
+                 top_k,
+                 args,
+                 max_len=128):
+        self.data_path = f'{args.data_path}/{task_name}/{data_name}/{data_type}.json'
+        self.max_len = max_len
+        self.tokenizer = tokenizer
+        self.task_name = task_name
+        self.data_name = data_name
+        self.data_type = data_type
+        self.args = args
 
-            tokenized_target = self.tokenizer.batch_encode_plus(
-                [target],
-                max_length=target_max_length,
-                padding="max_length",
-                truncation=True,
-                return_tensors="pt")
+        self.top_k = top_k
 
+        self.target_max_length = 1024 if data_type == "test" else max_len
+        self.buffer_size = args.shuffle_buffer if data_type == "train" else 0
+        # the splits get_transformed_io builds every view of, or the top one
+        self.multi_view = data_type == "train" or args.eval_data_split == "dev" or data_type == "test"
+        self.views = len(get_orders(args.task, data_name, args, None, None)[:min(10, top_k)]) \
+            if self.multi_view else 1
+        # sentences built and tokenized together
+        self.chunk_size = max(1, TOKENIZE_BATCH_SIZE // self.views)
+        # counted once here, rather than by each worker's copy
+        with open(self.data_path, 'r', encoding='UTF-8') as fp:
+            self.num_lines = sum(1 for _ in fp)
+        # token ids of the description of each event type met
+        self.event_descriptions = {}
+        self.token_ids = marker_token_ids(tokenizer)
 
-            tokenized_event_description = self.tokenizer.batch_encode_plus(
-                [event_description],
-                max_length=100,
-                padding="max_length",
-                truncation=True,
-                return_tensors="pt")  
+    def __len__(self):
+        return self.num_lines * self.views
+
+    def _shard(self):
+        """
+        Shard of the lines read by this worker of this rank, and the number
+        of shards. Under distributed training every shard gets as many lines,
+        the last ones being dropped, so that the ranks step together.
+        """
+        rank, world_size = 0, 1
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        num_shards = world_size * num_workers
+        num_lines = self.num_lines
+        if world_size > 1 and self.data_type == "train":
+            num_lines -= num_lines % num_shards
+        return rank * num_workers + worker_id, num_shards, num_lines
+
+    def _chunks(self):
+        shard, num_shards, num_lines = self._shard()
+        chunk = []
+        with open(self.data_path, 'r', encoding='UTF-8') as fp:
+            for n, line in enumerate(fp):
+                if n >= num_lines:
+                    break
+                if n % num_shards != shard:
+                    continue
+                words, events = parse_json_example(json.loads(line), self.args.lowercase)
+                chunk.append((n, words, events))
+                if len(chunk) == self.chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def _tokenize(self, texts, max_length):
+        tokenized = self.tokenizer.batch_encode_plus(texts,
+                                                     max_length=max_length,
+                                                     padding=True,
+                                                     truncation=True,
+                                                     return_tensors="pt")
+        return tokenized["input_ids"], tokenized["attention_mask"].sum(dim=1)
+
+    def _examples(self, chunk, rng):
+        numbers, sents, labels = zip(*chunk)
+        if self.multi_view:
+            inputs, targets, event_descriptions, event_types = get_para_targets_eae(
+                list(sents), list(labels), self.data_name, self.data_type, self.top_k,
+                self.args.task, self.args, rng=rng)
+        else:
+            inputs, targets, event_descriptions, event_types = get_para_targets_eae_dev(
+                list(sents), list(labels), self.data_name, self.args.task, self.args, rng=rng)
+        source_ids, source_lengths = self._tokenize([' '.join(input) for input in inputs], self.max_len)
+        target_ids, target_lengths = self._tokenize(targets, self.target_max_length)
+        if self.args.length_caps:
+            max_lengths = max_target_lengths(source_ids, self.token_ids, self.args.max_slot_length, self.max_len,
+                                             source_max_length=self.max_len)
+        else:
+            max_lengths = torch.full((len(inputs),), self.max_len)
+        for i, (event_type, event_description) in enumerate(zip(event_types, event_descriptions)):
+            if event_type not in self.event_descriptions:
+                ids, lengths = self._tokenize([event_description], 100)
+                self.event_descriptions[event_type] = ids[0, :lengths[0]]
+            # copies, so that the shuffle buffer does not hold whole chunks
+            yield {
+                "index": numbers[i // self.views] * self.views + i % self.views,
+                "source_ids": source_ids[i, :source_lengths[i]].clone(),
+                "target_ids": target_ids[i, :target_lengths[i]].clone(),
+                "event_description_ids": self.event_descriptions[event_type],
+                "event_type": event_type,
+                "max_length": int(max_lengths[i]),
+            }
+
+    def head(self, n):
+        """
+        The first `n` examples of the file, built apart from the iteration:
+        without the shuffle buffer, with a generator of their own
+        """
+        with open(self.data_path, 'r', encoding='UTF-8') as fp:
+            chunk = [(number, *parse_json_example(json.loads(line), self.args.lowercase))
+                     for number, line in enumerate(itertools.islice(fp, n))]
+        return list(self._examples(chunk, random.Random(self.args.seed)))[:n] if chunk else []
+
+    def __iter__(self):
+        # the DataLoader draws the seed of each worker anew every epoch from
+        # the torch generator, drawn from likewise without workers
+        worker = get_worker_info()
+        seed = worker.seed if worker is not None else int(torch.empty((), dtype=torch.int64).random_().item())
+        rng = random.Random(seed)
+        buffer = []
+        for chunk in self._chunks():
+            for example in self._examples(chunk, rng):
+                if self.buffer_size:
+                    buffer.append(example)
+                    if len(buffer) < self.buffer_size:
+                        continue
+                    i = rng.randrange(len(buffer))
+                    buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                    example = buffer.pop()
+                yield example
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+def load_dataset(tokenizer, task_name, data_name, data_type, top_k, args, max_len=128):
+    """
+    StreamingABSADataset with --streaming, ABSADataset otherwise
+    """
+    dataset_class = StreamingABSADataset if args.streaming else ABSADataset
+    return dataset_class(tokenizer, task_name, data_name, data_type, top_k, args, max_len=max_len)
+
+
+def pad_batch(batch, pad_token_id=0, fixed_lengths=None, pad_targets=True):
+    """
+    Collate examples, padding the ids of each field to its longest sequence
+    in the batch, or to its length in `fixed_lengths` (e.g. the full-length
+    sources and event descriptions fixed pooling expects), with their masks.
+    Without `pad_targets`, the target ids are kept as a list of unpadded
+    tensors, for evaluation decoding them back to text.
+    """
+    fields = ["source", "target", "event_description"]
+    collated = default_collate([
+        {key: value for key, value in example.items() if not key.endswith("_ids")}
+        for example in batch
+    ])
+    for field in fields:
+        rows = [example[f"{field}_ids"] for example in batch]
+        if field == "target" and not pad_targets:
+            collated["target_ids"] = rows
+            continue
+        length = (fixed_lengths or {}).get(field) or max(row.size(0) for row in rows)
+        ids = torch.full((len(rows), length), pad_token_id, dtype=torch.long)
+        mask = torch.zeros(len(rows), length, dtype=torch.long)
+        for i, row in enumerate(rows):
+            ids[i, :row.size(0)] = row
+            mask[i, :row.size(0)] = 1
+        collated[f"{field}_ids"] = ids
+        collated[f"{field}_mask"] = mask
+    return collated
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Batches of examples of similar lengths, each holding as many examples as
+    fit in `max_tokens` padded tokens: the batch size times the sum, over the
+    fields of `lengths` (e.g. source and target lengths), of the longest
+    sequence of the batch. An example over the budget makes a batch alone.
+
+    With `shuffle`, the examples are shuffled, sorted by length within
+    buckets of `bucket_size` examples, and the batches shuffled, all seeded
+    by `seed` and the epoch. Without it, the whole dataset is sorted by
+    length, an order evaluation undoes through the index of each example.
+    The batches are built once per epoch, for both __len__ and __iter__.
+    """
 
+    def __init__(self, lengths, max_tokens, shuffle=False, bucket_size=2048, seed=0):
+        self.lengths = np.stack([np.asarray(field, dtype=np.int64) for field in lengths], axis=1)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.epoch = 0
+        # epoch the batches were built for, and the batches
+        self.batches_epoch = None
+        self.batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        if self.batches_epoch != self.epoch:
+            self.batches = self._build_batches()
+            self.batches_epoch = self.epoch
+        return self.batches
+
+    def _build_batches(self):
+        order = np.arange(len(self.lengths))
+        rng = random.Random(self.seed + self.epoch)
+        if self.shuffle:
+            rng.shuffle(order)
+            buckets = [order[start:start + self.bucket_size]
+                       for start in range(0, len(order), self.bucket_size)]
+        else:
+            buckets = [order]
+        batches = []
+        for bucket in buckets:
+            bucket = bucket[np.argsort(self.lengths[bucket].sum(axis=1), kind="stable")]
+            batch, longest = [], np.zeros(self.lengths.shape[1], dtype=np.int64)
+            for index in bucket:
+                grown = np.maximum(longest, self.lengths[index])
+                if batch and (len(batch) + 1) * grown.sum() > self.max_tokens:
+                    batches.append(batch)
+                    batch, grown = [], self.lengths[index]
+                batch.append(int(index))
+                longest = grown
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self._batches())
+
+    def __len__(self):
+        return len(self._batches())
 
-            self.inputs.append(tokenized_input)
-            self.targets.append(tokenized_target)
-            self.event_descriptions.append(tokenized_event_description)
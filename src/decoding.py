@@ -0,0 +1,616 @@
+import torch
+
+from transformers.models.t5.modeling_t5 import T5Attention
+
+from constrained_decoding import EOS_ID, ConstraintEngine
+
+
+def _split_heads(attention, states):
+    B, N, _ = states.shape
+    return states.view(B, N, attention.n_heads,
+                       attention.key_value_proj_dim).transpose(1, 2)
+
+
+def _attend(attention, hidden_states, keys, values, bias):
+    """
+    T5 attention of `hidden_states` over projected keys/values, `bias`
+    holding the position bias and the mask
+    """
+    B, N, _ = hidden_states.shape
+    queries = _split_heads(attention, attention.q(hidden_states))
+    scores = queries @ keys.transpose(-2, -1) + bias
+    weights = scores.float().softmax(dim=-1).type_as(scores)
+    weights = torch.nn.functional.dropout(weights,
+                                          p=attention.dropout,
+                                          training=attention.training)
+    output = (weights @ values).transpose(1, 2).reshape(B, N, attention.inner_dim)
+    return attention.o(output)
+
+
+class DecoderCache:
+    """
+    Keys/values of the T5 decoder: self-attention over the tokens fed so far
+    and cross-attention over the encoder states, per layer. Rows may be fed a
+    different number of tokens per step: each step appends a block of
+    columns, of which only the leading `counts` tokens of each row are real,
+    and every key keeps its position in its own row. The self-attention
+    keys/values live in buffers of `capacity` columns, preallocated and
+    written in place, which only grow (doubling) if a decode outruns them.
+    With `num_beams`, each encoder row is followed by that many hypotheses.
+    """
+
+    def __init__(self, decoder, encoder_hidden_states, encoder_attention_mask,
+                 capacity=64, num_beams=1):
+        self.cross = []
+        for block in decoder.block:
+            attention = block.layer[1].EncDecAttention
+            self.cross.append(tuple(
+                _split_heads(attention, states).repeat_interleave(num_beams, dim=0)
+                for states in (attention.k(encoder_hidden_states),
+                               attention.v(encoder_hidden_states))
+            ))
+        dtype = encoder_hidden_states.dtype
+        self.cross_bias = (encoder_attention_mask[:, None, None, :] == 0).to(
+            dtype).repeat_interleave(num_beams, dim=0) * torch.finfo(dtype).min
+        attention = decoder.block[0].layer[0].SelfAttention
+        self.batch_size = encoder_hidden_states.size(0) * num_beams
+        device = encoder_hidden_states.device
+        # keys then values of each layer, positions and validity of the columns
+        self._buffers = [
+            torch.empty(self.batch_size, attention.n_heads, capacity,
+                        attention.key_value_proj_dim, dtype=dtype, device=device)
+            for _ in range(2 * len(decoder.block))
+        ] + [
+            torch.zeros(self.batch_size, capacity, dtype=torch.long, device=device),
+            torch.zeros(self.batch_size, capacity, dtype=torch.bool, device=device),
+        ]
+        self._spares = None
+        self.size = 0
+        self._end = 0
+        self.lengths = torch.zeros(self.batch_size, dtype=torch.long, device=device)
+
+    @staticmethod
+    def _columns(buffer, end):
+        return buffer[..., :end, :] if buffer.dim() == 4 else buffer[:, :end]
+
+    def _grow(self, end):
+        capacity = max(end, 2 * self._buffers[-1].size(1))
+        grown = []
+        for buffer in self._buffers:
+            shape = list(buffer.shape)
+            shape[2 if buffer.dim() == 4 else 1] = capacity
+            new = buffer.new_zeros(shape)
+            self._columns(new, self.size).copy_(self._columns(buffer, self.size))
+            grown.append(new)
+        self._buffers = grown
+        self._spares = None
+
+    def extend(self, positions, valid):
+        """
+        Start a step appending the (batch, K) columns of `positions`, and
+        return the positions and validity of all the columns, the new included
+        """
+        self._end = self.size + positions.size(1)
+        if self._end > self._buffers[-1].size(1):
+            self._grow(self._end)
+        key_positions, key_valid = [
+            self._columns(buffer[:self.batch_size], self._end)
+            for buffer in self._buffers[-2:]
+        ]
+        key_positions[:, self.size:] = positions
+        key_valid[:, self.size:] = valid
+        return key_positions, key_valid
+
+    def append(self, layer, keys, values):
+        """
+        Write the keys/values of the step to `layer`, and return all of them
+        """
+        columns = []
+        for buffer, new in zip(self._buffers[2 * layer:2 * layer + 2], (keys, values)):
+            buffer = self._columns(buffer[:self.batch_size], self._end)
+            buffer[:, :, self.size:] = new
+            columns.append(buffer)
+        return columns
+
+    def commit(self, counts):
+        """
+        End the step, `counts` being the real tokens of each row
+        """
+        self.size = self._end
+        self.lengths = self.lengths + counts
+
+    def _gather(self, index):
+        if self._spares is None:
+            self._spares = [torch.empty_like(buffer) for buffer in self._buffers]
+        for buffer, spare in zip(self._buffers, self._spares):
+            torch.index_select(self._columns(buffer[:self.batch_size], self.size), 0, index,
+                               out=self._columns(spare[:index.size(0)], self.size))
+        self._buffers, self._spares = self._spares, self._buffers
+        self.batch_size = index.size(0)
+        self.lengths = self.lengths[index]
+
+    def reorder(self, index):
+        """
+        Follow the hypotheses when beam search reshuffles them, gathering the
+        self-attention keys/values into the spare buffers in place. The beams of
+        an example share its cross-attention states, which are left as they are.
+        """
+        self._gather(index)
+
+    def select(self, index):
+        """
+        Keep the rows of `index` only, e.g. the unfinished ones
+        """
+        self._gather(index)
+        self.cross = [(keys[index], values[index]) for keys, values in self.cross]
+        self.cross_bias = self.cross_bias[index]
+
+
+def decoder_step(decoder, cache, tokens, counts):
+    """
+    Run the T5 decoder over a (batch, K) block of new tokens, the first
+    `counts` of each row being real, and return its (batch, K, d_model)
+    hidden states
+    """
+    offsets = torch.arange(tokens.size(1), device=tokens.device)
+    last = (counts - 1).clamp(min=0)
+    positions = cache.lengths[:, None] + torch.minimum(offsets[None], last[:, None])
+    valid = offsets[None] < counts[:, None]
+    key_positions, key_valid = cache.extend(positions, valid)
+
+    attention = decoder.block[0].layer[0].SelfAttention
+    bucket = T5Attention._relative_position_bucket(
+        key_positions[:, None, :] - positions[:, :, None],
+        bidirectional=False,
+        num_buckets=attention.relative_attention_num_buckets,
+    )
+    bias = attention.relative_attention_bias(bucket).permute(0, 3, 1, 2)
+    visible = key_valid[:, None, :] & (key_positions[:, None, :] <= positions[:, :, None])
+    bias = bias.masked_fill(~visible[:, None], torch.finfo(bias.dtype).min)
+
+    hidden_states = decoder.dropout(decoder.embed_tokens(tokens))
+    for i, block in enumerate(decoder.block):
+        self_attention, cross_attention, feed_forward = block.layer
+        normed = self_attention.layer_norm(hidden_states)
+        keys, values = cache.append(
+            i,
+            _split_heads(self_attention.SelfAttention, self_attention.SelfAttention.k(normed)),
+            _split_heads(self_attention.SelfAttention, self_attention.SelfAttention.v(normed)),
+        )
+        hidden_states = hidden_states + self_attention.dropout(
+            _attend(self_attention.SelfAttention, normed, keys, values, bias))
+        normed = cross_attention.layer_norm(hidden_states)
+        hidden_states = hidden_states + cross_attention.dropout(
+            _attend(cross_attention.EncDecAttention, normed, *cache.cross[i], cache.cross_bias))
+        hidden_states = feed_forward(hidden_states)
+
+    cache.commit(counts)
+    return decoder.dropout(decoder.final_layer_norm(hidden_states))
+
+
+def _encode(model, input_ids, attention_mask, event_description_ids,
+            event_description_mask):
+    """
+    Encoder states of the inputs and their event cross-attention summary
+    """
+    hidden_states = model.get_encoder()(input_ids=input_ids,
+                                        attention_mask=attention_mask,
+                                        return_dict=True).last_hidden_state
+    cross_attn_cls = model.event_cross_attention(
+        hidden_states,
+        model.encode_event_description(event_description_ids,
+                                       event_description_mask).last_hidden_state,
+        attention_mask,
+        event_description_mask,
+    )
+    return hidden_states, cross_attn_cls
+
+
+def _argmax_logits(model, hidden_states, allowed=None):
+    """
+    Best token and its logit for each row of (batch, d_model) decoder
+    outputs. With an `allowed` mask, only the rows of lm_head some hypothesis
+    may emit are projected on, rather than the whole vocabulary.
+    """
+    if allowed is None:
+        return model.lm_head(hidden_states).max(dim=-1)
+    vocab_ids = allowed.any(dim=0).nonzero().squeeze(1)
+    if vocab_ids.numel() == 0:
+        # no row may emit anything: project on the whole vocabulary, as generate does
+        vocab_ids = torch.arange(allowed.size(1), device=allowed.device)
+        logits = model.lm_head(hidden_states)
+    elif isinstance(model.lm_head, torch.nn.Linear):
+        logits = torch.nn.functional.linear(hidden_states, model.lm_head.weight[vocab_ids])
+    else:
+        # the packed weights of a quantised lm_head cannot be sliced
+        logits = model.lm_head(hidden_states)[:, vocab_ids]
+    logits = logits.masked_fill(~allowed[:, vocab_ids], -float("inf"))
+    scores, index = logits.max(dim=-1)
+    # generate takes the first token, the pad token, of a row with every logit at -inf
+    tokens = vocab_ids[index].masked_fill(scores == -float("inf"), model.config.pad_token_id)
+    return scores, tokens
+
+
+def _decode(model,
+            cache,
+            cross_attn_cls,
+            prefix,
+            prefix_lengths,
+            max_lengths,
+            constraint=None,
+            fast_forward=False,
+            stop_token_ids=(),
+            force_eos=False):
+    """
+    Greedy decoding loop: extend the right-padded `prefix` of each row, its
+    decoder start token included, until EOS, one of `stop_token_ids` or
+    `max_lengths` tokens, the last of which is forced to EOS with `force_eos`.
+    Returns the padded sequences, their lengths and the summed scores of the
+    decoded tokens (forced tokens are not scored).
+    Under a constraint the logits are only computed for the allowed tokens.
+    Finished rows are dropped from the cache, `cross_attn_cls` and the
+    constraint, so that later steps run on the unfinished rows only.
+    """
+    config = model.config
+    batch_size = prefix.size(0)
+    device = prefix.device
+    sequences = torch.full((batch_size, max(int(max_lengths.max()), prefix.size(1))),
+                           config.pad_token_id, dtype=torch.long, device=device)
+    sequences[:, :prefix.size(1)] = prefix
+    lengths = prefix_lengths.clone()
+    stops = torch.tensor([config.eos_token_id] + list(stop_token_ids), device=device)
+    scores = torch.zeros(batch_size, device=device)
+    # rows of the batch still decoding, the state below being theirs only
+    rows = torch.arange(batch_size, device=device)
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+    def _append(tokens, active):
+        appended = rows[active]
+        sequences[appended, lengths[appended]] = tokens[active]
+        lengths[appended] += 1
+        stopped = (tokens[:, None] == stops).any(dim=-1)
+        return finished | (active & stopped) | (lengths[rows] >= max_lengths[rows])
+
+    vocab_size = model.lm_head.out_features
+    block = prefix
+    counts = prefix_lengths
+    allowed = None
+    if constraint is not None:
+        for column in range(prefix.size(1)):
+            constraint.advance(prefix[:, column], column < prefix_lengths)
+    while True:
+        hidden = decoder_step(model.decoder, cache, block, counts)
+        hidden = hidden[torch.arange(rows.size(0), device=device),
+                        (counts - 1).clamp(min=0)].unsqueeze(1)
+        if constraint is not None and allowed is None:
+            allowed = constraint.allowed(vocab_size)
+        next_scores, next_tokens = _argmax_logits(
+            model, ((hidden + cross_attn_cls) * (model.model_dim ** -0.5)).squeeze(1), allowed)
+        if force_eos:
+            capped = lengths[rows] >= max_lengths[rows] - 1
+            next_tokens = next_tokens.masked_fill(capped, config.eos_token_id)
+            next_scores = next_scores.masked_fill(capped, 0)
+        active = ~finished
+        scores[rows] += next_scores.masked_fill(finished, 0)
+        finished = _append(next_tokens, active)
+        columns = [next_tokens]
+        counts = active.long()
+        allowed = None
+        if constraint is not None:
+            constraint.advance(next_tokens, active)
+        while fast_forward and constraint is not None and not finished.all():
+            # a row the constraint lets choose stops here, its state no longer changes
+            allowed = constraint.allowed(vocab_size)
+            forced = ~finished & (allowed.sum(dim=1) == 1)
+            if force_eos:
+                forced &= lengths[rows] < max_lengths[rows] - 1
+            if not forced.any():
+                break
+            tokens = allowed.int().argmax(dim=1)
+            finished = _append(tokens, forced)
+            constraint.advance(tokens, forced)
+            columns.append(tokens)
+            counts = counts + forced.long()
+            allowed = None
+        if finished.all():
+            break
+        block = torch.stack(columns, dim=1)
+        if finished.any():
+            keep = (~finished).nonzero().squeeze(1)
+            rows, finished = rows[keep], finished[keep]
+            block, counts = block[keep], counts[keep]
+            cross_attn_cls = cross_attn_cls[keep]
+            cache.select(keep)
+            if constraint is not None:
+                constraint.reorder(keep)
+            if allowed is not None:
+                allowed = allowed[keep]
+    return sequences, lengths, scores
+
+
+@torch.no_grad()
+def greedy_search(model,
+                  input_ids,
+                  attention_mask,
+                  event_description_ids,
+                  event_description_mask,
+                  max_length,
+                  constraint=None,
+                  fast_forward=False):
+    """
+    Greedy decoding of MyT5ForConditionalGeneration up to `max_length`, one
+    for the batch or, as a tensor, one per row whose last position is forced
+    to EOS as MaxLengthsLogitsProcessor does, scores masked by the
+    `constraint` logits processor if any. With `fast_forward`, the tokens the
+    constraint leaves no choice for are appended right away and fed to the
+    decoder together with the next decoded token, in one forward. Returns the
+    sequences, as `generate` does, and the summed scores of the decoded
+    tokens (forced tokens are not scored).
+    """
+    hidden_states, cross_attn_cls = _encode(model, input_ids, attention_mask,
+                                            event_description_ids,
+                                            event_description_mask)
+    batch_size = input_ids.size(0)
+    device = input_ids.device
+    prefix = torch.full((batch_size, 1), model.config.decoder_start_token_id,
+                        dtype=torch.long, device=device)
+    ones = torch.ones(batch_size, dtype=torch.long, device=device)
+    max_lengths = torch.as_tensor(max_length, device=device).expand(batch_size)
+    cache = DecoderCache(model.decoder, hidden_states, attention_mask,
+                         capacity=int(max_lengths.max()))
+    sequences, lengths, scores = _decode(model, cache, cross_attn_cls, prefix,
+                                         ones, max_lengths, constraint,
+                                         fast_forward,
+                                         force_eos=torch.is_tensor(max_length))
+    return sequences[:, :int(lengths.max())], scores
+
+
+@torch.no_grad()
+def slot_search(model,
+                input_ids,
+                attention_mask,
+                event_description_ids,
+                event_description_mask,
+                max_slot_length,
+                token_ids,
+                engine=None,
+                event_types=None):
+    """
+    Decode the prompt after each sentence slot by slot: every empty slot of
+    the prompt, i.e. the trigger and the argument of each role of the event
+    type, is decoded greedily as its own short sequence, all the slots of the
+    batch in one batch over the encoder output of their example. The decoder
+    is fed the prompt up to the slot, the slots before it left as "null"
+    except for the triggers, which are decoded first. A slot ends before its
+    first '[' (or EOS), so one argument is kept per role. `token_ids` are
+    the marker ids of the tokenizer, from marker_token_ids. Returns the
+    filled prompts as `generate` sequences and the summed scores of the slots.
+    """
+    config = model.config
+    device = input_ids.device
+    hidden_states, cross_attn_cls = _encode(model, input_ids, attention_mask,
+                                            event_description_ids,
+                                            event_description_mask)
+    template_table, template_blank, _ = ConstraintEngine.template_tables(input_ids, token_ids)
+    prompts, blanks = [], []
+    for tokens, blank in zip(template_table.tolist(), template_blank.tolist()):
+        # a prompt cut off by truncation leaves nothing to fill
+        end = tokens.index(EOS_ID) if EOS_ID in tokens else 0
+        prompts.append(tokens[:end])
+        blanks.append([p for p in range(end + 1) if blank[p]])
+    fills = [{} for _ in prompts]
+    scores = torch.zeros(input_ids.size(0), device=device)
+
+    def _filled(i, end):
+        ids = [config.decoder_start_token_id]
+        for p in range(end):
+            if p in fills[i]:
+                ids += fills[i][p]
+            elif p in blanks[i]:
+                ids += token_ids['null']
+            ids.append(prompts[i][p])
+        return ids
+
+    def _decode_slots(slots):
+        if not slots:
+            return
+        index = torch.tensor([i for i, _ in slots], device=device)
+        prefixes = [_filled(i, p) for i, p in slots]
+        prefix_lengths = torch.tensor([len(ids) for ids in prefixes], device=device)
+        prefix = torch.full((len(slots), int(prefix_lengths.max())),
+                            config.pad_token_id, dtype=torch.long, device=device)
+        for row, ids in enumerate(prefixes):
+            prefix[row, :len(ids)] = torch.tensor(ids, device=device)
+        constraint = None
+        if engine is not None:
+            constraint = engine.logits_processor(
+                input_ids[index],
+                [event_types[i] for i, _ in slots] if event_types is not None else None)
+        cache = DecoderCache(model.decoder, hidden_states[index], attention_mask[index],
+                             capacity=prefix.size(1) + max_slot_length)
+        sequences, lengths, slot_scores = _decode(
+            model, cache, cross_attn_cls[index], prefix, prefix_lengths,
+            prefix_lengths + max_slot_length, constraint,
+            stop_token_ids=token_ids['['])
+        scores.index_add_(0, index, slot_scores)
+        for (i, p), ids, start, end in zip(slots, sequences.tolist(),
+                                           prefix_lengths.tolist(), lengths.tolist()):
+            span = ids[start:end]
+            if span and span[-1] in token_ids['['] + [EOS_ID]:
+                span = span[:-1]
+            fills[i][p] = span or token_ids['null']
+
+    slots = [(i, p) for i in range(len(prompts)) for p in blanks[i]]
+    _decode_slots([(i, p) for i, p in slots if prompts[i][p - 2] == token_ids['T'][0]])
+    _decode_slots([(i, p) for i, p in slots if p not in fills[i]])
+
+    outputs = [_filled(i, len(prompts[i])) + fills[i].get(len(prompts[i]), [])
+               + [EOS_ID] for i in range(len(prompts))]
+    sequences = torch.full((len(outputs), max(len(ids) for ids in outputs)),
+                           config.pad_token_id, dtype=torch.long, device=device)
+    for row, ids in enumerate(outputs):
+        sequences[row, :len(ids)] = torch.tensor(ids, device=device)
+    return sequences, scores
+
+
+@torch.no_grad()
+def beam_search(model,
+                input_ids,
+                attention_mask,
+                event_description_ids,
+                event_description_mask,
+                max_length,
+                num_beams,
+                constraint=None,
+                length_penalty=1.0,
+                early_stopping=True,
+                num_return_sequences=1):
+    """
+    Beam search of MyT5ForConditionalGeneration, following the beam search of
+    `generate`, with the hypotheses of all examples kept in tensors rather than
+    per example lists. `max_length` is one for the batch or, as a tensor, one
+    per example, EOS being forced at the last position of each example as
+    MaxLengthsLogitsProcessor does. Examples whose search is done leave the
+    batch. Returns `num_return_sequences` sequences per example and their
+    scores, as the sequences and sequences_scores of `generate`.
+    """
+    config = model.config
+    device = input_ids.device
+    batch_size, k = input_ids.size(0), num_beams
+    force_eos = torch.is_tensor(max_length)
+    max_lengths = torch.as_tensor(max_length, device=device).expand(batch_size)
+    width = int(max_lengths.max())
+    hidden_states, cross_attn_cls = _encode(model, input_ids, attention_mask,
+                                            event_description_ids,
+                                            event_description_mask)
+    cache = DecoderCache(model.decoder, hidden_states, attention_mask,
+                         capacity=width, num_beams=k)
+    cross_attn_cls = cross_attn_cls.repeat_interleave(k, dim=0)
+    vocab_size = model.lm_head.out_features
+    eos = config.eos_token_id
+
+    # hypotheses of the examples still searched, `examples` mapping them to the batch
+    examples = torch.arange(batch_size, device=device)
+    sequences = torch.full((batch_size * k, width), config.pad_token_id,
+                           dtype=torch.long, device=device)
+    sequences[:, 0] = config.decoder_start_token_id
+    beam_scores = torch.zeros(batch_size, k, device=device)
+    beam_scores[:, 1:] = -1e9
+    # finished hypotheses of every example, empty slots scored below any hypothesis
+    hyp_tokens = torch.full((batch_size, k, width), config.pad_token_id,
+                            dtype=torch.long, device=device)
+    hyp_lengths = torch.zeros(batch_size, k, dtype=torch.long, device=device)
+    hyp_scores = torch.full((batch_size, k), -float("inf"), device=device)
+    hyp_counts = torch.zeros(batch_size, dtype=torch.long, device=device)
+    lowest = torch.finfo(hyp_scores.dtype).min
+
+    def _add_hypotheses(rows, tokens, lengths, scores, added):
+        """
+        Keep the k best hypotheses of the examples `rows` among theirs and the
+        new `added` ones
+        """
+        pool_scores = torch.cat((hyp_scores[rows], scores.clamp(min=lowest).masked_fill(
+            ~added, -float("inf"))), dim=1)
+        pool_tokens = torch.cat((hyp_tokens[rows], tokens), dim=1)
+        pool_lengths = torch.cat((hyp_lengths[rows], lengths), dim=1)
+        best = pool_scores.topk(k, dim=1).indices
+        hyp_scores[rows] = pool_scores.gather(1, best)
+        hyp_tokens[rows] = pool_tokens.gather(1, best[..., None].expand(-1, -1, width))
+        hyp_lengths[rows] = pool_lengths.gather(1, best)
+        hyp_counts[rows] = (hyp_counts[rows] + added.sum(dim=1)).clamp(max=k)
+
+    tokens = sequences[:, 0]
+    ones = torch.ones(batch_size * k, dtype=torch.long, device=device)
+    if constraint is not None:
+        constraint.advance(tokens)
+    cur_len = 1
+    while cur_len < width:
+        n = examples.size(0)
+        hidden = decoder_step(model.decoder, cache, tokens[:, None], ones[:n * k])
+        logits = model.lm_head((hidden + cross_attn_cls) * (model.model_dim ** -0.5)).squeeze(1)
+        scores = logits.log_softmax(dim=-1)
+        if constraint is not None:
+            scores = scores.masked_fill(~constraint.allowed(vocab_size), -float("inf"))
+        forced = (cur_len >= max_lengths[examples] - 1).repeat_interleave(k) & force_eos
+        if forced.any():
+            scores[forced] = -float("inf")
+            scores[forced, eos] = 0
+        scores = (scores + beam_scores.view(-1, 1)).view(n, k * vocab_size)
+        scores, candidates = scores.topk(2 * k, dim=1)
+        beams = (candidates // vocab_size) + torch.arange(n, device=device)[:, None] * k
+        candidates = candidates % vocab_size
+
+        is_eos = candidates == eos
+        finished = is_eos & (torch.arange(2 * k, device=device) < k)
+        if finished.any():
+            _add_hypotheses(examples, sequences[beams], torch.full_like(beams, cur_len),
+                            scores / cur_len ** length_penalty, finished)
+        # the next beams are the k best candidates that do not end
+        selected = (~is_eos & ((~is_eos).cumsum(dim=1) <= k)).nonzero()[:, 1].view(n, k)
+        best_score = scores[:, 0]
+        beam_scores = scores.gather(1, selected)
+        beam_idx = beams.gather(1, selected).view(-1)
+        tokens = candidates.gather(1, selected).view(-1)
+        sequences = sequences[beam_idx]
+        sequences[:, cur_len] = tokens
+        cache.reorder(beam_idx)
+        if constraint is not None:
+            constraint.reorder(beam_idx)
+            constraint.advance(tokens)
+        cur_len += 1
+
+        done = hyp_counts[examples] >= k
+        if not early_stopping:
+            worst = hyp_scores[examples].min(dim=1).values
+            done &= worst >= best_score / (cur_len - 1) ** length_penalty
+        if done.all():
+            examples = examples[:0]
+            break
+        if done.any():
+            keep = (~done).nonzero().squeeze(1)
+            rows = (keep[:, None] * k + torch.arange(k, device=device)).view(-1)
+            examples, beam_scores = examples[keep], beam_scores[keep]
+            sequences, tokens = sequences[rows], tokens[rows]
+            cross_attn_cls = cross_attn_cls[rows]
+            cache.select(rows)
+            if constraint is not None:
+                constraint.reorder(rows)
+
+    if examples.size(0) > 0:
+        # open beams of the examples not done compete with their hypotheses
+        n = examples.size(0)
+        _add_hypotheses(examples, sequences.view(n, k, width),
+                        torch.full((n, k), cur_len, dtype=torch.long, device=device),
+                        beam_scores / cur_len ** length_penalty,
+                        torch.ones(n, k, dtype=torch.bool, device=device))
+
+    order = hyp_scores.argsort(dim=1, descending=True)[:, :num_return_sequences]
+    scores = hyp_scores.gather(1, order).view(-1)
+    lengths = hyp_lengths.gather(1, order).view(-1)
+    best = hyp_tokens.gather(1, order[..., None].expand(-1, -1, width)).view(-1, width)
+    rows = torch.arange(best.size(0), device=device)
+    # EOS after each sequence when it fits, as generate does
+    fits = lengths < width
+    best[rows[fits], lengths[fits]] = eos
+    return best[:, :min(int(lengths.max()) + 1, width)], scores
+
+
+def decode(model,
+           input_ids,
+           attention_mask,
+           event_description_ids,
+           event_description_mask,
+           max_length,
+           num_beams=1,
+           constraint=None,
+           fast_forward=False):
+    """
+    Decode a batch with greedy search, or beam search with `num_beams`, and
+    return the sequences and their scores: the summed scores of the decoded
+    tokens under greedy search, the sequences_scores of `generate` otherwise
+    """
+    if num_beams > 1:
+        return beam_search(model, input_ids, attention_mask, event_description_ids,
+                           event_description_mask, max_length, num_beams, constraint)
+    return greedy_search(model, input_ids, attention_mask, event_description_ids,
+                         event_description_mask, max_length, constraint, fast_forward)
@@ -0,0 +1,288 @@
+import argparse
+import json
+import os
+
+import torch
+from torch import nn
+from transformers.models.t5.modeling_t5 import T5Attention
+
+from t5 import MyT5ForConditionalGeneration
+from decoding import _split_heads, _attend
+
+GRAPHS = ("encoder", "event", "decoder")
+
+
+def init_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path",
+                        required=True,
+                        type=str,
+                        help='checkpoint saved by save_pretrained, e.g. <output_dir>/final')
+    parser.add_argument("--output_dir", required=True, type=str)
+    parser.add_argument("--format", default="onnx", choices=["onnx", "torchscript"], type=str)
+    parser.add_argument("--head", default=4, type=int)
+    return parser.parse_args()
+
+
+class EncoderGraph(nn.Module):
+    """
+    Encoder states of the inputs, followed by the cross-attention keys and
+    values of every decoder layer over them
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        hidden_states = self.model.encoder(input_ids=input_ids,
+                                           attention_mask=attention_mask,
+                                           return_dict=True).last_hidden_state
+        cross = []
+        for block in self.model.decoder.block:
+            attention = block.layer[1].EncDecAttention
+            cross.append(_split_heads(attention, attention.k(hidden_states)))
+            cross.append(_split_heads(attention, attention.v(hidden_states)))
+        return (hidden_states, *cross)
+
+
+class EventGraph(nn.Module):
+    """
+    Event description encoder, pooling and CrossMultiAttention, producing the
+    cross_attn_cls summary added to every decoder position
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, hidden_states, attention_mask, event_description_ids,
+                event_description_mask):
+        hidden_states_event = self.model.encoder(input_ids=event_description_ids,
+                                                 attention_mask=event_description_mask,
+                                                 return_dict=True).last_hidden_state
+        return self.model.event_cross_attention(hidden_states, hidden_states_event,
+                                                attention_mask, event_description_mask)
+
+
+class DecoderGraph(nn.Module):
+    """
+    One decoder step: the logits of the next token after `input_ids` given
+    the self-attention keys/values of the previous tokens, followed by those
+    keys/values extended with the step. `states` holds the self-attention
+    keys and values of every layer, then their cross-attention ones. The
+    layers are run as decoding.decoder_step runs them, since the position
+    bias of T5Attention freezes the past length when traced.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, cross_attn_cls, *states):
+        decoder = self.model.decoder
+        num_layers = len(decoder.block)
+        attention = decoder.block[0].layer[0].SelfAttention
+        # the step is at the position of the past length, after every key
+        past_length = states[0].size(2)
+        bucket = T5Attention._relative_position_bucket(
+            torch.arange(past_length + 1, device=input_ids.device) - past_length,
+            bidirectional=False,
+            num_buckets=attention.relative_attention_num_buckets,
+        )
+        self_bias = attention.relative_attention_bias(bucket).t()[None, :, None, :]
+        dtype = self_bias.dtype
+        cross_bias = (attention_mask[:, None, None, :] == 0).to(dtype) * torch.finfo(dtype).min
+
+        hidden_states = decoder.embed_tokens(input_ids)
+        present = []
+        for i, block in enumerate(decoder.block):
+            self_attention, cross_attention, feed_forward = block.layer
+            normed = self_attention.layer_norm(hidden_states)
+            keys, values = [
+                torch.cat((past, _split_heads(self_attention.SelfAttention, projection(normed))), dim=2)
+                for past, projection in zip(states[2 * i:2 * i + 2],
+                                            (self_attention.SelfAttention.k, self_attention.SelfAttention.v))
+            ]
+            present += [keys, values]
+            hidden_states = hidden_states + _attend(self_attention.SelfAttention, normed, keys, values, self_bias)
+            normed = cross_attention.layer_norm(hidden_states)
+            cross_keys, cross_values = states[2 * (num_layers + i):2 * (num_layers + i) + 2]
+            hidden_states = hidden_states + _attend(cross_attention.EncDecAttention, normed,
+                                                    cross_keys, cross_values, cross_bias)
+            hidden_states = feed_forward(hidden_states)
+        sequence_output = decoder.final_layer_norm(hidden_states) + cross_attn_cls
+        logits = self.model.lm_head(sequence_output * (self.model.model_dim ** -0.5))[:, -1]
+        return (logits, *present)
+
+
+def _example_inputs(model, batch_size=2, past_length=2):
+    """
+    Inputs to trace the graphs with, padded as fixed pooling expects. The
+    past is not empty so that the trace keeps its length as a variable.
+    """
+    config = model.config
+    device = model.shared.weight.device
+    source_length = model.linear_sent.in_features
+    event_length = model.linear_event.in_features
+    input_ids = torch.full((batch_size, source_length), config.eos_token_id, device=device)
+    attention_mask = torch.ones(batch_size, source_length, dtype=torch.long, device=device)
+    event_description_ids = torch.full((batch_size, event_length), config.eos_token_id, device=device)
+    event_description_mask = torch.ones(batch_size, event_length, dtype=torch.long, device=device)
+    shape = (batch_size, config.num_heads, past_length, config.d_kv)
+    past = [torch.zeros(shape, device=device) for _ in range(2 * config.num_decoder_layers)]
+    return input_ids, attention_mask, event_description_ids, event_description_mask, past
+
+
+def _io_names(num_layers):
+    """
+    Input and output names of each graph, and their dynamic axes
+    """
+    self_states = [f"{kind}_{i}" for i in range(num_layers) for kind in ("self_key", "self_value")]
+    cross_states = [f"{kind}_{i}" for i in range(num_layers) for kind in ("cross_key", "cross_value")]
+    present = [f"present_{name}" for name in self_states]
+    names = {
+        "encoder": (["input_ids", "attention_mask"], ["hidden_states"] + cross_states),
+        "event": (["hidden_states", "attention_mask", "event_description_ids", "event_description_mask"],
+                  ["cross_attn_cls"]),
+        "decoder": (["decoder_input_ids", "attention_mask", "cross_attn_cls"]
+                    + self_states + cross_states, ["logits"] + present),
+    }
+    axes = {"input_ids": {0: "batch", 1: "source"},
+            "attention_mask": {0: "batch", 1: "source"},
+            "hidden_states": {0: "batch", 1: "source"},
+            "event_description_ids": {0: "batch", 1: "event"},
+            "event_description_mask": {0: "batch", 1: "event"},
+            "cross_attn_cls": {0: "batch"},
+            "decoder_input_ids": {0: "batch"},
+            "logits": {0: "batch"}}
+    axes.update({name: {0: "batch", 2: "past"} for name in self_states})
+    axes.update({name: {0: "batch", 2: "past_and_step"} for name in present})
+    axes.update({name: {0: "batch", 2: "source"} for name in cross_states})
+    return names, axes
+
+
+@torch.no_grad()
+def export_model(model, output_dir, export_format="onnx"):
+    """
+    Export the encoder, event and decoder step graphs of `model` to
+    `output_dir`, as ONNX or TorchScript, with the config ExportedModel reads
+    """
+    model.eval()
+    config = model.config
+    input_ids, attention_mask, event_description_ids, event_description_mask, past = _example_inputs(model)
+    hidden_states, *cross = EncoderGraph(model)(input_ids, attention_mask)
+    cross_attn_cls = EventGraph(model)(hidden_states, attention_mask,
+                                       event_description_ids, event_description_mask)
+    decoder_input_ids = torch.full((input_ids.size(0), 1), config.decoder_start_token_id,
+                                   device=input_ids.device)
+    examples = {
+        "encoder": (input_ids, attention_mask),
+        "event": (hidden_states, attention_mask, event_description_ids, event_description_mask),
+        "decoder": (decoder_input_ids, attention_mask, cross_attn_cls, *past, *cross),
+    }
+    # the exporter restores the mode of the graphs, and so of `model`, when it is done
+    graphs = {"encoder": EncoderGraph(model).eval(), "event": EventGraph(model).eval(),
+              "decoder": DecoderGraph(model).eval()}
+    names, axes = _io_names(config.num_decoder_layers)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for name in GRAPHS:
+        if export_format == "onnx":
+            input_names, output_names = names[name]
+            torch.onnx.export(graphs[name], examples[name], os.path.join(output_dir, f"{name}.onnx"),
+                              input_names=input_names,
+                              output_names=output_names,
+                              dynamic_axes={key: value for key, value in axes.items()
+                                            if key in input_names + output_names},
+                              opset_version=13)
+        else:
+            traced = torch.jit.trace(graphs[name], examples[name], check_trace=False)
+            traced.save(os.path.join(output_dir, f"{name}.pt"))
+    with open(os.path.join(output_dir, "config.json"), "w") as f:
+        json.dump({
+            "format": export_format,
+            "num_layers": config.num_decoder_layers,
+            "num_heads": config.num_heads,
+            "d_kv": config.d_kv,
+            "decoder_start_token_id": config.decoder_start_token_id,
+            "pad_token_id": config.pad_token_id,
+            "eos_token_id": config.eos_token_id,
+        }, f, indent=2)
+
+
+class ExportedModel:
+    """
+    Greedy decoding with the graphs saved by export_model, on CPU, run by
+    onnxruntime or TorchScript. Steps follow the greedy search of generate:
+    the logits processors (constraints, length caps, score accumulation)
+    are applied to the logits of every step.
+    """
+
+    def __init__(self, export_dir):
+        with open(os.path.join(export_dir, "config.json")) as f:
+            self.config = json.load(f)
+        self.format = self.config["format"]
+        self.input_names = {name: names[0] for name, names in _io_names(self.config["num_layers"])[0].items()}
+        if self.format == "onnx":
+            import onnxruntime
+            self.graphs = {
+                name: onnxruntime.InferenceSession(os.path.join(export_dir, f"{name}.onnx"),
+                                                   providers=["CPUExecutionProvider"])
+                for name in GRAPHS
+            }
+        else:
+            self.graphs = {
+                name: torch.jit.load(os.path.join(export_dir, f"{name}.pt"), map_location="cpu")
+                for name in GRAPHS
+            }
+
+    def run(self, name, *inputs):
+        if self.format == "torchscript":
+            outputs = self.graphs[name](*inputs)
+            return outputs if isinstance(outputs, tuple) else (outputs,)
+        session = self.graphs[name]
+        # the exporter drops the inputs a graph does not use, e.g. the masks under fixed pooling
+        used = {arg.name for arg in session.get_inputs()}
+        feed = {input_name: tensor.cpu().numpy()
+                for input_name, tensor in zip(self.input_names[name], inputs) if input_name in used}
+        return tuple(torch.from_numpy(output) for output in session.run(None, feed))
+
+    @torch.no_grad()
+    def generate(self, input_ids, attention_mask, event_description_ids,
+                 event_description_mask, max_length, logits_processor=None):
+        """
+        Greedy search up to `max_length` tokens, the decoder start token
+        included, padding the rows that reached EOS
+        """
+        config = self.config
+        hidden_states, *cross = self.run("encoder", input_ids, attention_mask)
+        (cross_attn_cls,) = self.run("event", hidden_states, attention_mask,
+                                     event_description_ids, event_description_mask)
+        batch_size = input_ids.size(0)
+        sequences = input_ids.new_full((batch_size, 1), config["decoder_start_token_id"])
+        past = [hidden_states.new_zeros(batch_size, config["num_heads"], 0, config["d_kv"])
+                for _ in range(2 * config["num_layers"])]
+        unfinished = torch.ones(batch_size, dtype=torch.bool)
+        while True:
+            logits, *past = self.run("decoder", sequences[:, -1:], attention_mask,
+                                     cross_attn_cls, *past, *cross)
+            if logits_processor is not None:
+                logits = logits_processor(sequences, logits)
+            tokens = logits.argmax(dim=-1).masked_fill(~unfinished, config["pad_token_id"])
+            sequences = torch.cat((sequences, tokens[:, None]), dim=1)
+            unfinished &= tokens != config["eos_token_id"]
+            if not unfinished.any() or sequences.size(1) >= max_length:
+                return sequences
+
+
+def main():
+    args = init_args()
+    # the graphs follow the pooling the checkpoint was trained with
+    model = MyT5ForConditionalGeneration.from_pretrained(args.model_path, head=args.head)
+    export_model(model.cpu(), args.output_dir, args.format)
+    print(f"{', '.join(GRAPHS)} graphs exported to {args.output_dir}")
+
+
+if __name__ == '__main__':
+    main()
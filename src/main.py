@@ -1,10 +1,12 @@
 import argparse
+import importlib.util
 import os
 import sys
 import logging
 import pickle
 from functools import partial
 import time
+import itertools
 from tqdm import tqdm
 from collections import Counter
 import random
@@ -23,14 +25,19 @@ from pytorch_lightning.callbacks import LearningRateMonitor
 _device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
-from transformers import AdamW, T5Tokenizer
-from t5 import MyT5ForConditionalGeneration
+from transformers import AdamW, T5Config, T5Tokenizer
+from t5 import MyT5ForConditionalGeneration, EventDescriptionCache, MaxLengthsLogitsProcessor, ScoreAccumulator
+from decoding import decode, slot_search
 from transformers import get_linear_schedule_with_warmup
+from transformers.generation_logits_process import LogitsProcessorList
 
-from data_utils import ABSADataset, task_data_list, cal_entropy
+from data_utils import load_dataset, task_data_list, cal_entropy, pad_batch, TokenBudgetBatchSampler
 from const import *
 from data_utils import read_line_examples_from_json_file
 from eval_utils import compute_scores, extract_spans_para
+from constrained_decoding import ConstraintEngine, marker_token_ids
+from export import export_model, ExportedModel
+from quantization import quantize_model, is_quantized, save_quantized, load_quantized, is_cached
 logging.getLogger("pytorch_lightning").setLevel(logging.INFO)
 logger = logging.getLogger("pytorch_lightning.core")
 
@@ -90,6 +97,11 @@ def init_args():
                         default=8,
                         type=int,
                         help="Batch size per GPU/CPU for training.")
+    parser.add_argument("--max_tokens",
+                        default=None,
+                        type=int,
+                        help='form batches of examples of similar length within this budget of padded source and '
+                        'target tokens, instead of train_batch_size/eval_batch_size examples')
     parser.add_argument("--eval_batch_size",
                         default=8,
                         type=int,
@@ -144,6 +156,70 @@ def init_args():
                         default="True",
                         type=str,
                         help='constrained decoding when evaluating')
+    parser.add_argument("--constrained_decode_mode",
+                        default="trie",
+                        choices=["trie", "bag", "template"],
+                        type=str,
+                        help='trie: only real source spans and role names, bag: any source token or role token, '
+                        'template: trie, following the prompt of the input')
+    parser.add_argument("--fast_forward",
+                        action='store_true',
+                        help='greedy decoding appending the tokens the constraints leave no choice for without a decoding step of their own')
+    parser.add_argument("--use_generate",
+                        action='store_true',
+                        help='decode with transformers generate instead of the decoding loop of decoding.py')
+    parser.add_argument("--benchmark_decoding",
+                        action='store_true',
+                        help='before inference, compare generate and the decoding loop on the evaluation split')
+    parser.add_argument("--slot_decode",
+                        action='store_true',
+                        help='decode the trigger and each role argument of the prompt as its own short sequence, in one batch')
+    parser.add_argument("--max_slot_length",
+                        default=32,
+                        type=int,
+                        help='maximum number of tokens a prompt slot is filled with by --slot_decode or, with --length_caps, '
+                        'allowed per slot of the prompt')
+    parser.add_argument("--length_caps",
+                        action='store_true',
+                        help='cap the generation length of each example by its prompt, with --max_slot_length tokens per slot '
+                        'and up to 3 arguments per role, instead of --max_seq_length; longer targets are cut off')
+    parser.add_argument("--pooling",
+                        default=None,
+                        choices=["fixed", "masked"],
+                        type=str,
+                        help='fixed: inputs padded to 250/100 tokens, masked: batches padded to their longest input; '
+                        'defaults to the pooling of the checkpoint, which a different pooling has to be fine-tuned with '
+                        'by --do_train before inference')
+    parser.add_argument("--event_description_cache",
+                        default=None,
+                        type=str,
+                        help='file persisting the event description encodings across inference runs')
+    parser.add_argument("--token_cache",
+                        default=None,
+                        type=str,
+                        help='directory of pre-tokenized datasets, memory-mapped by later runs building the same examples')
+    parser.add_argument("--streaming",
+                        action='store_true',
+                        help='read the data files lazily, building and tokenizing the examples in the DataLoader workers')
+    parser.add_argument("--shuffle_buffer",
+                        default=10000,
+                        type=int,
+                        help='with --streaming, number of training examples shuffled together')
+    parser.add_argument("--export_format",
+                        default=None,
+                        choices=["onnx", "torchscript"],
+                        type=str,
+                        help='export the encoder, event cross-attention and decoder step graphs to output_dir/<format> '
+                        'and decode greedily with them on CPU')
+    parser.add_argument("--quantize",
+                        default=None,
+                        choices=["int8"],
+                        type=str,
+                        help='run inference on CPU with dynamic int8 quantisation of the Linear layers, '
+                        'the quantised model being cached in output_dir')
+    parser.add_argument("--compare_fp32",
+                        action='store_true',
+                        help='with --quantize, also evaluate the fp32 model and report the F1 deltas')
     parser.add_argument('--agg_strategy', type=str, default='vote', choices=['vote', 'rand', 'heuristic', 'pre_rank', 'post_rank'])
     parser.add_argument("--data_ratio",
                         default=1.0,
@@ -151,6 +227,28 @@ def init_args():
                         help="low resource data ratio")
 
     args = parser.parse_args()
+    if args.fast_forward and args.beam_size > 1:
+        parser.error("--fast_forward decodes greedily, use --beam_size 1")
+    if args.fast_forward and args.use_generate:
+        parser.error("--fast_forward needs the decoding loop, drop --use_generate")
+    if args.slot_decode and (args.beam_size > 1 or args.fast_forward):
+        parser.error("--slot_decode decodes greedily, use --beam_size 1 without --fast_forward")
+    if args.export_format and (args.beam_size > 1 or args.fast_forward or args.slot_decode or args.use_generate):
+        parser.error("--export_format decodes greedily with the exported graphs, use --beam_size 1 "
+                     "without --fast_forward, --slot_decode or --use_generate")
+    if args.export_format == "onnx" and importlib.util.find_spec("onnxruntime") is None:
+        parser.error("--export_format onnx decodes with onnxruntime, pip install onnxruntime "
+                     "or use --export_format torchscript")
+    if args.export_format and args.quantize:
+        parser.error("--export_format traces the fp32 model, drop --quantize")
+    if args.compare_fp32 and not args.quantize:
+        parser.error("--compare_fp32 compares against the quantised model, set --quantize")
+    if args.streaming and args.max_tokens:
+        parser.error("--max_tokens sorts the whole dataset by length, drop it with --streaming")
+    if args.token_cache and args.multi_task:
+        parser.error("--token_cache caches the examples of a single task, drop --multi_task")
+    if args.streaming and args.multi_task:
+        parser.error("--streaming builds the examples of a single task, drop --multi_task")
     if not os.path.exists('./outputs'):
         os.mkdir('./outputs')
 
@@ -171,6 +269,9 @@ class T5FineTuner(pl.LightningModule):
         self.config = config
         self.model = tfm_model
         self.tokenizer = tokenizer
+        self.constraint_engines = {}
+        # ExportedModel the evaluation decodes with, if any
+        self.exported = None
 
     def forward(self,
                 input_ids,
@@ -213,17 +314,20 @@ class T5FineTuner(pl.LightningModule):
         return loss
 
     def evaluate(self, batch, stage=None):
-        outs = self.model.generate(input_ids=batch['source_ids'], 
-                                   attention_mask=batch['source_mask'], 
-                                   event_description_ids=batch['event_description_ids'],
-                                   event_description_mask=batch['event_description_mask'],
-                                   max_length=self.config.max_seq_length, 
-                                   return_dict_in_generate=True,
-                                   output_scores=True,
-                                   num_beams=1) 
+        # checkpoints are selected on greedy unconstrained decoding, whatever the
+        # decoding flags of inference
+        sequences, _ = decode(
+            self.model,
+            batch['source_ids'],
+            batch['source_mask'],
+            batch["event_description_ids"],
+            batch["event_description_mask"],
+            # a length, rather than caps, stops without forcing EOS as generate does
+            max_length=batch['max_length'].to(self.model.device) if args.length_caps else self.config.max_seq_length,
+        )
         dec = [
             self.tokenizer.decode(ids, skip_special_tokens=True)
-            for ids in outs.sequences
+            for ids in sequences
         ]  
         target = [
             self.tokenizer.decode(ids, skip_special_tokens=True)
@@ -250,6 +354,12 @@ class T5FineTuner(pl.LightningModule):
                      prog_bar=True,
                      on_step=False,
                      on_epoch=True)
+            if args.length_caps and not args.slot_decode:
+                self.log(f"{stage}_capped_rows",
+                         float(capped_rows(sequences, batch['max_length'], self.model.config.eos_token_id)),
+                         on_step=False,
+                         on_epoch=True,
+                         reduce_fx="sum")
 
     def validation_step(self, batch, batch_idx):
         self.evaluate(batch, "val")
@@ -293,127 +403,249 @@ class T5FineTuner(pl.LightningModule):
 
     def train_dataloader(self):
         print("load training data.")
-        train_dataset = ABSADataset(tokenizer=self.tokenizer,
-                                    task_name=args.task,
-                                    data_name=args.dataset,
-                                    data_type="train",
-                                     top_k=self.config.top_k,
-                                    args=self.config,
-                                    max_len=self.config.max_seq_length)
-
-        dataloader = DataLoader(
+        train_dataset = load_dataset(tokenizer=self.tokenizer,
+                                     task_name=args.task,
+                                     data_name=args.dataset,
+                                     data_type="train",
+                                      top_k=self.config.top_k,
+                                     args=self.config,
+                                     max_len=self.config.max_seq_length)
+
+        dataloader = self.data_loader(
             train_dataset,
-            batch_size=self.config.train_batch_size,
+            self.config.train_batch_size,
             drop_last=True
             if args.data_ratio > 0.3 else False, # don't drop on few-shot
-            shuffle=True,
-            num_workers=2)
+            shuffle=True)
 
         return dataloader
 
     def val_dataloader(self):
-        val_dataset = ABSADataset(tokenizer=self.tokenizer,
-                                  task_name=args.task,
-                                  data_name=args.dataset,
-                                  data_type="dev",
-                                  top_k=self.config.num_path,
-                                  args=self.config,
-                                  max_len=self.config.max_seq_length)
-        return DataLoader(val_dataset,
-                          batch_size=self.config.eval_batch_size,
+        val_dataset = load_dataset(tokenizer=self.tokenizer,
+                                   task_name=args.task,
+                                   data_name=args.dataset,
+                                   data_type="dev",
+                                   top_k=self.config.num_path,
+                                   args=self.config,
+                                   max_len=self.config.max_seq_length)
+        return self.data_loader(val_dataset, self.config.eval_batch_size)
+
+    def collate_fn(self, pad_targets=True):
+        """
+        pad_batch padding to the longest sequences of each batch, but for the
+        sources and event descriptions under fixed pooling, which expects them
+        at their full length
+        """
+        fixed_lengths = None
+        if self.model.pooling == "fixed":
+            fixed_lengths = {"source": self.config.max_seq_length, "event_description": 100}
+        return partial(pad_batch,
+                       pad_token_id=self.tokenizer.pad_token_id,
+                       fixed_lengths=fixed_lengths,
+                       pad_targets=pad_targets)
+
+    def data_loader(self, dataset, batch_size, shuffle=False, drop_last=False, pad_targets=True):
+        """
+        DataLoader of `batch_size` examples, or with --max_tokens of batches
+        of similar lengths within that budget. The lengths budgeted are the
+        ones pad_batch pads to: the sources, at full length under fixed
+        pooling, and the targets, or the bounds decoding works to when the
+        targets are not padded.
+        """
+        collate_fn = self.collate_fn(pad_targets=pad_targets)
+        if not self.config.max_tokens:
+            return DataLoader(dataset,
+                              batch_size=batch_size,
+                              # streamed examples are shuffled by the dataset
+                              shuffle=shuffle and not self.config.streaming,
+                              drop_last=drop_last,
+                              collate_fn=collate_fn,
+                              num_workers=2)
+        source_lengths = dataset.source_lengths
+        if self.model.pooling == "fixed":
+            source_lengths = np.full(len(dataset), self.config.max_seq_length)
+        target_lengths = dataset.target_lengths if pad_targets else dataset.max_lengths
+        batch_sampler = TokenBudgetBatchSampler([source_lengths, target_lengths],
+                                                self.config.max_tokens,
+                                                shuffle=shuffle,
+                                                seed=self.config.seed)
+        return DataLoader(dataset,
+                          batch_sampler=batch_sampler,
+                          collate_fn=collate_fn,
                           num_workers=2)
 
-    @staticmethod
-    def rindex(_list, _value):
-        return len(_list) - _list[::-1].index(_value) - 1
-
-    def prefix_allowed_tokens_fn(self, task, data_name, source_ids, batch_id,
-                                 input_ids):
+    def get_constraint_engine(self, task, data_name):
         """
-        Constrained Decoding
+        Constrained Decoding, the engine is built once per (task, dataset)
         """
-        dic = {"type_tokens":[], "all_tokens":{}, "role_tokens":[], 'special_tokens':[]} 
-        type_tokens = []
-        for i in cate_list_eae[data_name]:
-            type_tokens.extend(self.tokenizer(i, return_tensors='pt')['input_ids'].tolist()[0]) 
-        dic["type_tokens"] = type_tokens
-        role_tokens = []
-        for i in force_words_eae[task][data_name]:
-            role_tokens.extend(self.tokenizer(i, return_tensors='pt')['input_ids'].tolist()[0]) 
-        dic["role_tokens"] = role_tokens
-        special_tokens_tokenize_res = []
-        for w in ['[T','[A','[R','[SS']:
-            special_tokens_tokenize_res.extend(self.tokenizer(w, return_tensors='pt')['input_ids'].tolist()[0])  
-        special_tokens_tokenize_res = [r for r in special_tokens_tokenize_res if r != 784] 
-        dic['special_tokens'] = special_tokens_tokenize_res                                                
-        import json
-        with open("./force_tokens.json", 'w', encoding='utf-8') as f:
-            json.dump(dic, f, indent=4)
-            
-        force_tokens = dic
-        to_id = {
-            'T': [382], # 'T'  TriggeR
-            'A': [188],  # 'A' ArgumenT
-            'R': [448],  # 'R' Argument Role         
-            'SS': [4256],  # 'SS'
-            'EP': [8569],  # 'EP' [SSEP]
-            '[': [784],  # '▁['
-            ']': [908],  # ']'
-            'it': [34],  # '▁it'
-            'null': [206,195],  # '▁nu', 'll'
-        }
-        left_brace_index = (input_ids == to_id['['][0]).nonzero()
-        right_brace_index = (input_ids == to_id[']'][0]).nonzero()
-        num_left_brace = len(left_brace_index)
-        num_right_brace = len(right_brace_index)
-        last_right_brace_pos = right_brace_index[-1][
-            0] if right_brace_index.nelement() > 0 else -1
-        last_left_brace_pos = left_brace_index[-1][
-            0] if left_brace_index.nelement() > 0 else -1
-        cur_id = input_ids[-1]
-
-        if cur_id in to_id['[']:
-            return force_tokens['special_tokens']
-        elif cur_id in to_id['T'] + to_id['A'] + to_id['R'] + to_id['EP']:  
-            return to_id[']']  
-        elif (cur_id in to_id['SS']): 
-            return to_id['EP'] 
-        if last_left_brace_pos == -1: 
-            return to_id['['] + [1]   # start of sentence: [      ; [1] -> '</s>'
-        elif (last_left_brace_pos != -1 and last_right_brace_pos == -1) \
-            or last_left_brace_pos > last_right_brace_pos:
-            return to_id[']']  # ]
-        else:
-            cur_term = input_ids[last_left_brace_pos + 1]  
-
-        ret = []
-        if cur_term in to_id['T']:  # trigger
-            force_list = source_ids[batch_id].tolist() + to_id['null']
-            ret = force_list  
-        elif cur_term in to_id['SS']:
-            ret = [3] + to_id[']'] + [1]   
-        elif cur_term in to_id['R']:  # argument role
-            ret = force_tokens['role_tokens']
-        elif cur_term in to_id['A']:  # argument
-            force_list = source_ids[batch_id].tolist() + to_id['null'] 
-            if task == "eae":
-                force_list.extend(to_id['null'])  # null
-            ret = force_list
-        else:
-            raise ValueError(cur_term)
-
-        if num_left_brace == num_right_brace: 
-            ret = set(ret)
-            ret.discard(to_id[']'][0]) # remove ]
-            for w in force_tokens['special_tokens']:
-                ret.discard(w)
-            ret = list(ret)
-        elif num_left_brace > num_right_brace:
-            ret += to_id[']'] 
-        else:
-            raise ValueError
-        ret.extend(to_id['['] + [1]) # add [  
-        return ret 
+        key = (task, data_name)
+        if key not in self.constraint_engines:
+            self.constraint_engines[key] = ConstraintEngine(
+                self.tokenizer,
+                task,
+                data_name,
+                tries=self.config.constrained_decode_mode in ["trie", "template"],
+                template=self.config.constrained_decode_mode == "template")
+        return self.constraint_engines[key]
+
+
+def generation_processors(model, batch, constraint=None):
+    """
+    Logits processors of generate: the constraint, the length caps and the
+    score accumulator, returned as well
+    """
+    score_accumulator = ScoreAccumulator(model.model.config.eos_token_id)
+    logits_processor = LogitsProcessorList([
+        MaxLengthsLogitsProcessor(batch['max_length'], model.model.config.eos_token_id),
+        score_accumulator,
+    ])
+    if constraint is not None:
+        logits_processor.insert(0, constraint)
+    return logits_processor, score_accumulator
+
+
+def capped_rows(sequences, max_lengths, eos_token_id):
+    """
+    Number of decoded `sequences` that ran to their cap in `max_lengths`,
+    ending there without an EOS or with the one MaxLengthsLogitsProcessor
+    forces at the last position
+    """
+    eos = sequences.cpu() == eos_token_id
+    lengths = torch.where(eos.any(dim=1), eos.int().argmax(dim=1) + 1,
+                          torch.full_like(max_lengths, sequences.size(1)))
+    return int((lengths >= max_lengths).sum())
+
+
+def generate_batch(model, batch, constraint=None):
+    """
+    Decode a batch with transformers generate, returning the sequences and
+    their scores
+    """
+    logits_processor, score_accumulator = generation_processors(model, batch, constraint)
+    outs = model.model.generate(
+        input_ids=batch['source_ids'].to(model.model.device),
+        attention_mask=batch['source_mask'].to(model.model.device),
+        event_description_ids=batch["event_description_ids"].to(model.model.device),
+        event_description_mask=batch["event_description_mask"].to(model.model.device),
+        max_length=int(batch['max_length'].max()),
+        num_beams=args.beam_size,
+        early_stopping=True,
+        return_dict_in_generate=True,
+        # beam search only reports the score of its returned hypotheses with output_scores
+        output_scores=args.beam_size > 1,
+        logits_processor=logits_processor,
+    ) 
+    batch_probs = outs.sequences_scores if args.beam_size > 1 else score_accumulator.scores
+    return outs.sequences, batch_probs
+
+
+def decode_batch(model, batch, constraint=None):
+    """
+    Decode a batch with the decoding loop of decoding.py, returning the
+    sequences and their scores as generate_batch does
+    """
+    return decode(
+        model.model,
+        batch['source_ids'].to(model.model.device),
+        batch['source_mask'].to(model.model.device),
+        batch["event_description_ids"].to(model.model.device),
+        batch["event_description_mask"].to(model.model.device),
+        max_length=batch['max_length'].to(model.model.device),
+        num_beams=args.beam_size,
+        constraint=constraint,
+        fast_forward=args.fast_forward,
+    )
+
+
+def exported_batch(model, batch, constraint=None):
+    """
+    Decode a batch greedily with the exported graphs, as generate_batch does
+    """
+    logits_processor, score_accumulator = generation_processors(model, batch, constraint)
+    sequences = model.exported.generate(
+        batch['source_ids'],
+        batch['source_mask'],
+        batch["event_description_ids"],
+        batch["event_description_mask"],
+        max_length=int(batch['max_length'].max()),
+        logits_processor=logits_processor,
+    )
+    return sequences, score_accumulator.scores
+
+
+def predict_batch(model, batch, task, data):
+    """
+    Decode a batch as the flags of the run ask: slot filling, generate, the
+    exported graphs or the decoding loop, constrained by the engine of
+    (task, data) with --constrained_decode
+    """
+    device = model.model.device
+    engine = model.get_constraint_engine(task, data) if args.constrained_decode else None
+    constraint = engine.logits_processor(
+        batch['source_ids'].to(device), batch['event_type']) if engine is not None else None
+    if args.slot_decode:
+        return slot_search(
+            model.model,
+            batch['source_ids'].to(device),
+            batch['source_mask'].to(device),
+            batch["event_description_ids"].to(device),
+            batch["event_description_mask"].to(device),
+            max_slot_length=args.max_slot_length,
+            token_ids=marker_token_ids(model.tokenizer),
+            engine=engine,
+            event_types=batch['event_type'],
+        )
+    if args.use_generate:
+        return generate_batch(model, batch, constraint)
+    if model.exported is not None:
+        return exported_batch(model, batch, constraint)
+    return decode_batch(model, batch, constraint)
+
+
+def benchmark_decoding(model, task, data, data_type):
+    """
+    Decode a split with generate, with the decoding loop of decoding.py and
+    with the exported graphs if any, and compare their outputs and throughput
+    """
+    dataset = load_dataset(model.tokenizer,
+                           task_name=task,
+                           data_name=data,
+                           data_type=data_type,
+                           top_k=min(5, args.num_path),
+                           args=args,
+                           max_len=args.max_seq_length)
+    data_loader = model.data_loader(dataset, args.eval_batch_size, pad_targets=False)
+    model.model.to(_device)
+    model.model.eval()
+
+    decoders = {"generate": generate_batch, "decoding loop": decode_batch}
+    if model.exported is not None:
+        decoders["exported graphs"] = exported_batch
+    seconds = dict.fromkeys(decoders, 0.0)
+    tokens = dict.fromkeys(decoders, 0)
+    identical = total = 0
+    for batch in tqdm(data_loader):
+        outputs = {}
+        for name, decode_fn in decoders.items():
+            constraint = model.get_constraint_engine(task, data).logits_processor(
+                batch['source_ids'].to(_device), batch['event_type']) if args.constrained_decode else None
+            if _device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.time()
+            sequences, _ = decode_fn(model, batch, constraint)
+            if _device.type == "cuda":
+                torch.cuda.synchronize()
+            seconds[name] += time.time() - start
+            tokens[name] += int((sequences[:, 1:] != model.model.config.pad_token_id).sum())
+            outputs[name] = [
+                model.tokenizer.decode(ids, skip_special_tokens=True)
+                for ids in sequences
+            ]
+        identical += sum(len(set(texts)) == 1 for texts in zip(*outputs.values()))
+        total += len(outputs["generate"])
+    for name in decoders:
+        print(f"{name}: {tokens[name] / seconds[name]:.1f} tokens/s, {seconds[name]:.1f}s")
+    print(f"identical outputs: {identical}/{total}")
 
 
 def evaluate(model, task, data, data_type):
@@ -431,46 +663,36 @@ def evaluate(model, task, data, data_type):
         num_path = min(5, num_path)
 
     cache_file = os.path.join(
-        args.output_dir, "result_{}{}{}_{}_path{}_beam{}.pickle".format(
+        args.output_dir, "result_{}{}{}{}_{}_path{}_beam{}.pickle".format(
             "best_" if args.load_ckpt_name else "",
-            "cd_" if args.constrained_decode else "", task, data, num_path,
+            "cd_" if args.constrained_decode else "",
+            "int8_" if is_quantized(model.model) else "", task, data, num_path,
             args.beam_size))
     if args.load_path_cache:
         with open(cache_file, 'rb') as handle:
             (outputs, targets, probs) = pickle.load(handle)
     else:
-        dataset = ABSADataset(model.tokenizer,
-                              task_name=task,
-                              data_name=data,
-                              data_type=data_type,
-                              top_k=num_path,
-                              args=args,
-                              max_len=args.max_seq_length)
-        data_loader = DataLoader(dataset,
-                                 batch_size=args.eval_batch_size,
-                                 num_workers=2)
+        dataset = load_dataset(model.tokenizer,
+                               task_name=task,
+                               data_name=data,
+                               data_type=data_type,
+                               top_k=num_path,
+                               args=args,
+                               max_len=args.max_seq_length)
+        data_loader = model.data_loader(dataset, args.eval_batch_size, pad_targets=False)
         model.model.to(_device)
         model.model.eval()
 
+        indices = []
+        capped = 0
         for batch in tqdm(data_loader):
-            outs = model.model.generate(
-                input_ids=batch['source_ids'].to(_device),
-                attention_mask=batch['source_mask'].to(_device),
-                event_description_ids=batch["event_description_ids"].to(_device),
-                event_description_mask=batch["event_description_mask"].to(_device),
-                max_length=args.max_seq_length,
-                num_beams=args.beam_size,
-                early_stopping=True,
-                return_dict_in_generate=True,
-                output_scores=True,
-                prefix_allowed_tokens_fn=partial(
-                    model.prefix_allowed_tokens_fn, task, data,
-                    batch['source_ids']) if args.constrained_decode else None,
-            ) 
+            sequences, batch_probs = predict_batch(model, batch, task, data)
+            if args.length_caps and not args.slot_decode:
+                capped += capped_rows(sequences, batch['max_length'], model.model.config.eos_token_id)
 
             dec = [
                 model.tokenizer.decode(ids, skip_special_tokens=True)
-                for ids in outs.sequences
+                for ids in sequences
             ]
             target = [
                 model.tokenizer.decode(ids, skip_special_tokens=True)
@@ -481,10 +703,16 @@ def evaluate(model, task, data, data_type):
             targets.extend(target)
 
 
-            stacked_tensor = torch.stack(outs.scores, dim=1)
-            max_values, _ = torch.max(stacked_tensor, dim=2)
-            sum_max_values = torch.sum(max_values, dim=1)
-            probs.extend(sum_max_values.tolist())  
+            probs.extend(batch_probs.tolist())
+            indices.extend(batch["index"].tolist())
+        if args.length_caps and not args.slot_decode:
+            print(f"{capped} of {len(indices)} {data_type} examples reached their length cap")
+        # batches of --max_tokens come sorted by length, put the examples back in order
+        order = np.argsort(indices, kind="stable")
+        dec_outputs, outputs, targets, probs = [
+            [values[i] for i in order] for values in (dec_outputs, outputs, targets, probs)
+        ]
+        model.model.event_description_cache.save()
         with open(cache_file, 'wb') as handle:
             pickle.dump((outputs, targets, probs), handle)
 
@@ -581,21 +809,58 @@ def evaluate(model, task, data, data_type):
     return scores
 
 
+def evaluate_all(model, f):
+    """
+    Evaluate on the datasets of the run, writing the results to `f`, and
+    return their scores by (task, data)
+    """
+    results = {}
+    if args.multi_task:
+        f1s = []
+        for task in task_data_list:
+            for data in task_data_list[task]:
+                scores = evaluate(model, task, data, data_type=args.eval_data_split)
+                print(task, data, scores)
+                exp_results = "{} {} Arg_C : arg_prec: {:.2f} arg_rec: {:.2f} arg_f1: {:.2f} Arg_I: precision: {:.2f} recall: {:.2f} F1 = {:.2f}".format(
+                    args.eval_data_split, args.agg_strategy, scores['arg_I_prec'], scores['arg_I_recall'], scores['arg_I_f1'], scores['precision'], scores['recall'], scores['f1'])
+                f.write(f"{task}: \t{data}: \t{exp_results}\n")
+                f.flush()
+                f1s.append(scores['f1'])
+                results[(task, data)] = scores
+        f.write(f"Average F1: \t{sum(f1s) / len(f1s)}\n")
+        f.flush()
+    else:
+        scores = evaluate(model,
+                          args.task,
+                          args.dataset,
+                          data_type=args.eval_data_split)
+
+        exp_results = "{} {} Arg_C : arg_prec: {:.2f} arg_rec: {:.2f} arg_f1: {:.2f} Arg_I: precision: {:.2f} recall: {:.2f} F1 = {:.2f}".format(
+            args.eval_data_split, args.agg_strategy, scores['arg_I_prec'], scores['arg_I_recall'], scores['arg_I_f1'], scores['precision'], scores['recall'], scores['f1'])
+        print(exp_results)
+        f.write(exp_results + "\n")
+        f.flush()
+        results[(args.task, args.dataset)] = scores
+    return results
+
+
 def train_function(args):
+    global _device
     if args.do_train:
         print("\n", "=" * 30, f"NEW EXP: {args.task} on {args.dataset}",
               "=" * 30, "\n")
         tokenizer = T5Tokenizer.from_pretrained(args.model_name_or_path, local_files_only=True if args.model_name_or_path not in ["t5-large","t5-base"] else False)
         print(f"Here is an example (from the dev set):")
-        dataset = ABSADataset(tokenizer=tokenizer,
-                              task_name=args.task,
-                              data_name=args.dataset,
-                              data_type='train',
-                              top_k=args.top_k,
-                              args=args,
-                              max_len=args.max_seq_length)
-        for i in range(0, min(10, len(dataset))): 
-            data_sample = dataset[i]
+        dataset = load_dataset(tokenizer=tokenizer,
+                               task_name=args.task,
+                               data_name=args.dataset,
+                               data_type='train',
+                               top_k=args.top_k,
+                               args=args,
+                               max_len=args.max_seq_length)
+        # a streamed training set is not iterated for the samples, which would fill its shuffle buffer
+        samples = dataset.head(10) if args.streaming else itertools.islice(dataset, 10)
+        for data_sample in samples: 
             print(
                 'Input :',
                 tokenizer.decode(data_sample['source_ids'],
@@ -613,10 +878,16 @@ def train_function(args):
             args.model_name_or_path, local_files_only=True if args.model_name_or_path != "t5-large" else False, \
                 head = args.head
                 )
+        if args.pooling:
+            tfm_model.set_pooling(args.pooling)
         model = T5FineTuner(args, tfm_model, tokenizer)
         train_loader = model.train_dataloader()
-        t_total = ((len(train_loader.dataset) //
-                    (args.train_batch_size * max(1, args.n_gpu))) //
+        if args.max_tokens:
+            # batches per epoch depend on the lengths drawn together, the first epoch stands for all
+            batches = len(train_loader) // max(1, args.n_gpu)
+        else:
+            batches = len(train_loader.dataset) // (args.train_batch_size * max(1, args.n_gpu))
+        t_total = (batches //
                    args.gradient_accumulation_steps *
                    float(args.num_train_epochs))
 
@@ -671,45 +942,81 @@ def train_function(args):
         print(model_path)
         print(os.path.abspath(os.curdir))
         tokenizer = T5Tokenizer.from_pretrained(model_path)
-        tfm_model = MyT5ForConditionalGeneration.from_pretrained(model_path, head = args.head)
+        if args.load_ckpt_name:
+            weights_path = os.path.join(args.output_dir, args.load_ckpt_name)
+        else:
+            weights_path = os.path.join(model_path, "pytorch_model.bin")
+        quantized_path = os.path.join(
+            args.output_dir, f"{os.path.basename(weights_path)}.{args.quantize}.pt")
+        # the fp32 weights are only read when the fp32 model is evaluated or quantised again
+        load_cached = args.quantize and not args.compare_fp32 and is_cached(quantized_path, weights_path)
+        if load_cached:
+            print(f"Load quantized model from {quantized_path}")
+            tfm_model = load_quantized(T5Config.from_pretrained(model_path), args.head, quantized_path)
+        else:
+            tfm_model = MyT5ForConditionalGeneration.from_pretrained(model_path, head = args.head)
+        if args.pooling and args.pooling != tfm_model.pooling:
+            raise ValueError(f"{model_path} was trained with {tfm_model.pooling} pooling, whose outputs {args.pooling} "
+                             f"pooling changes: fine-tune it with --do_train --pooling {args.pooling} first")
+        tfm_model.event_description_cache = EventDescriptionCache(args.event_description_cache)
         model = T5FineTuner(args, tfm_model, tokenizer)
 
-        if args.load_ckpt_name:
-            ckpt_path = os.path.join(args.output_dir, args.load_ckpt_name)
-            print("Loading ckpt:", ckpt_path)
-            checkpoint = torch.load(ckpt_path)
+        if args.load_ckpt_name and not load_cached:
+            print("Loading ckpt:", weights_path)
+            checkpoint = torch.load(weights_path)
             model.load_state_dict(checkpoint["state_dict"])
 
+        fp32_model = None
+        if args.quantize:
+            # quantised Linear layers only run on CPU, the fp32 reference is timed there too
+            _device = torch.device("cpu")
+        if args.quantize and not load_cached:
+            if args.compare_fp32:
+                fp32_model = model
+            model = T5FineTuner(args, quantize_model(model.model), tokenizer)
+            save_quantized(model.model, quantized_path)
+            print(f"Quantized model saved to {quantized_path}")
+
+        if args.export_format:
+            # the graphs are exported and run on CPU
+            _device = torch.device("cpu")
+            export_dir = os.path.join(args.output_dir, args.export_format)
+            export_model(model.model.cpu(), export_dir, args.export_format)
+            model.exported = ExportedModel(export_dir)
+            print(f"Graphs exported to {export_dir}")
+
+        if args.benchmark_decoding:
+            benchmark_decoding(model, args.task, args.dataset, args.eval_data_split)
+
         log_file_path = os.path.join(args.output_dir, "result.txt")
         with open(log_file_path, "a+") as f:
-            config_str = f"seed: {args.seed}, beam: {args.beam_size}, constrained: {args.constrained_decode}\n"
+            config_str = f"seed: {args.seed}, beam: {args.beam_size}, constrained: {args.constrained_decode}, quantize: {args.quantize}\n"
             print(config_str)
             f.write(config_str)
 
-            if args.multi_task:
-                f1s = []
-                for task in task_data_list:
-                    for data in task_data_list[task]:
-                        scores = evaluate(model, task, data, data_type=args.eval_data_split)
-                        print(task, data, scores)
-                        exp_results = "{} {} Arg_C : arg_prec: {:.2f} arg_rec: {:.2f} arg_f1: {:.2f} Arg_I: precision: {:.2f} recall: {:.2f} F1 = {:.2f}".format(
-                            args.eval_data_split, args.agg_strategy, scores['arg_I_prec'], scores['arg_I_recall'], scores['arg_I_f1'], scores['precision'], scores['recall'], scores['f1'])
-                        f.write(f"{task}: \t{data}: \t{exp_results}\n")
-                        f.flush()
-                        f1s.append(scores['f1'])
-                f.write(f"Average F1: \t{sum(f1s) / len(f1s)}\n")
-                f.flush()
-            else:
-                scores = evaluate(model,
-                                  args.task,
-                                  args.dataset,
-                                data_type=args.eval_data_split) 
-
-                exp_results = "{} {} Arg_C : arg_prec: {:.2f} arg_rec: {:.2f} arg_f1: {:.2f} Arg_I: precision: {:.2f} recall: {:.2f} F1 = {:.2f}".format(
-                            args.eval_data_split, args.agg_strategy, scores['arg_I_prec'], scores['arg_I_recall'], scores['arg_I_f1'], scores['precision'], scores['recall'], scores['f1'])
-                print(exp_results)
-                f.write(exp_results + "\n")
+            start = time.time()
+            results = evaluate_all(model, f)
+            timing = f"Evaluation took {time.time() - start:.1f}s"
+            print(timing)
+            if args.quantize:
+                f.write(timing + "\n")
+            if fp32_model is not None:
+                f.write("fp32 reference:\n")
+                start = time.time()
+                fp32_results = evaluate_all(fp32_model, f)
+                timing = f"fp32 evaluation took {time.time() - start:.1f}s"
+                print(timing)
+                f.write(timing + "\n")
+                for (task, data), scores in results.items():
+                    fp32_scores = fp32_results[(task, data)]
+                    delta = "{} {} {} - fp32: arg_f1: {:+.2f} F1 = {:+.2f}".format(
+                        task, data, args.quantize,
+                        scores['arg_I_f1'] - fp32_scores['arg_I_f1'],
+                        scores['f1'] - fp32_scores['f1'])
+                    print(delta)
+                    f.write(delta + "\n")
                 f.flush()
+            scores = list(results.values())[-1]
     return scores['f1']
 
 
@@ -0,0 +1,48 @@
+import os
+
+import torch
+from torch import nn
+
+from t5 import MyT5ForConditionalGeneration, EventDescriptionCache
+
+
+def quantize_model(model):
+    """
+    Copy of `model` for CPU inference with dynamic int8 quantisation: the
+    weights of every nn.Linear (T5 blocks, lm_head, the event cross attention
+    and linear_event/linear_sent) are stored in int8 and the activations are
+    quantised on the fly. `model` itself is moved to CPU and left in fp32.
+    """
+    quantized = torch.quantization.quantize_dynamic(model.cpu().eval(), {nn.Linear},
+                                                    dtype=torch.qint8)
+    quantized.event_description_cache = EventDescriptionCache(model.event_description_cache.path)
+    return quantized
+
+
+def is_quantized(model):
+    return any(isinstance(module, torch.nn.quantized.dynamic.Linear)
+               for module in model.modules())
+
+
+def save_quantized(model, path):
+    torch.save(model.state_dict(), path)
+
+
+def load_quantized(config, head, path):
+    """
+    Model saved by save_quantized, built from `config` and quantised before
+    its int8 state dict is loaded, so the fp32 weights are never read
+    """
+    model = quantize_model(MyT5ForConditionalGeneration(config, head=head))
+    model.load_state_dict(torch.load(path, map_location="cpu"))
+    return model
+
+
+def is_cached(path, source):
+    """
+    Whether the model saved at `path` is newer than the weights at `source`
+    it was quantised from
+    """
+    if not os.path.exists(path):
+        return False
+    return not os.path.exists(source) or os.path.getmtime(path) >= os.path.getmtime(source)
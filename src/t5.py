@@ -4,7 +4,10 @@ from transformers.models.t5.modeling_t5 import *
 from transformers.file_utils import ModelOutput
 from transformers.generation_utils import *
 from transformers.generation_beam_search import *
+from transformers.generation_logits_process import LogitsProcessor
 import copy
+import hashlib
+import os
 
 
 _CONFIG_FOR_DOC = "T5Config"
@@ -69,7 +72,7 @@ class CrossMultiAttention(nn.Module):
         self.proj_drop = nn.Dropout(proj_drop)
         self.addnorm = AddNorm([1, dim])
 
-    def forward(self, y, x_cls):
+    def forward(self, y, x_cls, y_mask=None):
 
         y_all = torch.concat((y, x_cls), dim=1)  
         B, N, C = y_all.shape  
@@ -77,6 +80,10 @@ class CrossMultiAttention(nn.Module):
         k = self.wk(y_all).reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
         v = self.wv(y_all).reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
         attn = (q @ k.transpose(-2, -1)) * self.scale  
+        if y_mask is not None:
+            # padding of y is not attended, x_cls always is
+            key_mask = torch.cat((y_mask, y_mask.new_ones(B, 1)), dim=1)
+            attn = attn.masked_fill(key_mask[:, None, None, :] == 0, torch.finfo(attn.dtype).min)
         attn = attn.softmax(dim=-1)
 
         attn = self.attn_drop(attn)
@@ -88,6 +95,45 @@ class CrossMultiAttention(nn.Module):
 
         return self.addnorm(o)
 
+    def forward_pair(self, y1, x1_cls, y2, x2_cls, y1_mask=None, y2_mask=None):
+        """
+        forward(y1, x1_cls, y1_mask) + forward(y2, x2_cls, y2_mask) in one pass: both
+        queries attend to their own block of a single packed key/value projection
+        """
+        B, N1, C = y1.shape
+        N2 = y2.size(1)
+        x_cls = torch.cat((x1_cls, x2_cls), dim=1)
+        y_all = torch.cat((y1, x1_cls, y2, x2_cls), dim=1)
+        N = N1 + N2 + 2
+        if isinstance(self.wk, nn.Linear):
+            kv_bias = None if self.wk.bias is None else torch.cat((self.wk.bias, self.wv.bias))
+            kv = nn.functional.linear(y_all, torch.cat((self.wk.weight, self.wv.weight)), kv_bias)
+        else:
+            # quantised projections keep their packed weights apart
+            kv = torch.cat((self.wk(y_all), self.wv(y_all)), dim=-1)
+        k, v = kv.reshape(B, N, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        q = self.wq(x_cls).reshape(B, 2, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
+        attn = (q @ k.transpose(-2, -1)) * self.scale
+
+        first = torch.arange(N, device=y_all.device) <= N1
+        key_mask = torch.stack((first, ~first)).unsqueeze(0)
+        if y1_mask is not None or y2_mask is not None:
+            ones = y_all.new_ones(B, 1, dtype=torch.bool)
+            y1_mask = ones.expand(B, N1) if y1_mask is None else y1_mask != 0
+            y2_mask = ones.expand(B, N2) if y2_mask is None else y2_mask != 0
+            key_mask = key_mask & torch.cat((y1_mask, ones, y2_mask, ones), dim=1).unsqueeze(1)
+        attn = attn.masked_fill(~key_mask.unsqueeze(1), torch.finfo(attn.dtype).min)
+        attn = attn.softmax(dim=-1)
+
+        attn = self.attn_drop(attn)
+
+        x = (attn @ v).transpose(1, 2).reshape(B, 2, C)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        o = x + x_cls
+
+        return self.addnorm(o.unsqueeze(2)).sum(dim=1)
+
 class AddNorm(nn.Module):
 
     def __init__(self, normalized_shape, **kwargs):
@@ -98,8 +144,166 @@ class AddNorm(nn.Module):
         return self.ln(Y)
 
 
-
-
+class EventDescriptionCache:
+    """
+    Encoder outputs of the event descriptions, shared across batches and generate calls
+
+    Entries are keyed by the unpadded description tokens (one description per event
+    type) and belong to a fingerprint of the encoder weights, their dtype and device,
+    so they are dropped as soon as the weights change. With `path`, entries are
+    persisted for later runs by `save`.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._state = None
+        self._fingerprint = None
+        self._entries = {}
+        self._unsaved = False
+
+    def fingerprint(self, encoder):
+        parameters = list(encoder.parameters())
+        state = tuple((p._version, p.device, p.dtype) for p in parameters)
+        if state != self._state:
+            # the int8 weights of quantised Linear layers are not parameters
+            weights = parameters + [
+                module.weight().dequantize() for module in encoder.modules()
+                if isinstance(module, torch.nn.quantized.dynamic.Linear)
+            ]
+            sums = torch.stack([p.detach().double().sum() for p in weights])
+            digest = hashlib.sha1(sums.cpu().numpy().tobytes())
+            digest.update(str(sorted({str(p.dtype) for p in parameters})).encode())
+            fingerprint = digest.hexdigest()
+            device = sums.device
+            if fingerprint != self._fingerprint:
+                self._fingerprint = fingerprint
+                self._entries = self._load(fingerprint, device)
+                self._unsaved = False
+            else:
+                # the same weights moved to another device
+                self._entries = {key: value.to(device) for key, value in self._entries.items()}
+            self._state = state
+        return self._fingerprint
+
+    def _load(self, fingerprint, device):
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+        saved = torch.load(self.path, map_location=device)
+        if saved["fingerprint"] != fingerprint:
+            return {}
+        return saved["entries"]
+
+    def save(self):
+        """
+        Persist the entries to `path` if any were added since the last save
+        """
+        if self.path is None or not self._unsaved:
+            return
+        torch.save({
+            "fingerprint": self._fingerprint,
+            "entries": {key: value.cpu() for key, value in self._entries.items()},
+        }, self.path)
+        self._unsaved = False
+
+    def encode(self, encoder, input_ids, attention_mask, keep_padding=False):
+        """
+        `encoder` outputs of the descriptions, only encoding the ones not seen yet.
+        The outputs at padding positions are zeros, unless `keep_padding` (fixed
+        pooling reads every position), which keys the entries by padded length too.
+        """
+        self.fingerprint(encoder)
+        width = input_ids.size(1)
+        lengths = attention_mask.sum(dim=1).tolist()
+        keys = [
+            (tuple(ids[:length]), width if keep_padding else None)
+            for ids, length in zip(input_ids.tolist(), lengths)
+        ]
+        missing = {}
+        for i, key in enumerate(keys):
+            if key not in self._entries:
+                missing.setdefault(key, i)
+        if missing:
+            rows = torch.tensor(list(missing.values()), device=input_ids.device)
+            hidden_states = encoder(
+                input_ids=input_ids[rows],
+                attention_mask=attention_mask[rows],
+                return_dict=True,
+            ).last_hidden_state
+            for key, row, hidden_state in zip(missing, missing.values(), hidden_states):
+                self._entries[key] = hidden_state if keep_padding else hidden_state[:lengths[row]]
+            self._unsaved = True
+        entries = [self._entries[key] for key in keys]
+        last_hidden_state = entries[0].new_zeros(len(keys), width, entries[0].size(-1))
+        for i, entry in enumerate(entries):
+            last_hidden_state[i, :entry.size(0)] = entry
+        return BaseModelOutput(last_hidden_state=last_hidden_state)
+
+
+class ScoreAccumulator(LogitsProcessor):
+    """
+    Running sum of the best processed score of each row, i.e. the score of the chosen
+    token under greedy search, so generate does not have to keep every step's scores.
+    Rows that already emitted EOS and are only padded add nothing, as in the decoding
+    loop of decoding.py. Under beam search the sum follows each beam, reordered with
+    it, but is that of its best tokens rather than of the tokens the search chose:
+    beam scores are generate's sequences_scores. It must come last in the processor list.
+    """
+
+    def __init__(self, eos_token_id):
+        self.eos_token_id = eos_token_id
+        self.scores = None
+
+    def __call__(self, input_ids, scores):
+        best = scores.max(dim=-1).values
+        best = best.masked_fill((input_ids == self.eos_token_id).any(dim=1), 0)
+        self.scores = best if self.scores is None else self.scores + best
+        return scores
+
+    def reorder(self, beam_idx):
+        if self.scores is not None:
+            self.scores = self.scores.index_select(0, beam_idx)
+
+
+class MaxLengthsLogitsProcessor(LogitsProcessor):
+    """
+    Force EOS once a row reaches its own maximum length, `max_lengths` holding one
+    per example (its beams share it), so that a runaway hypothesis stops there
+    rather than at the max_length of the whole batch
+    """
+
+    def __init__(self, max_lengths, eos_token_id):
+        self.max_lengths = max_lengths
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids, scores):
+        num_beams = input_ids.size(0) // self.max_lengths.size(0)
+        max_lengths = self.max_lengths.to(input_ids.device).repeat_interleave(num_beams)
+        done = input_ids.size(1) >= max_lengths - 1
+        if done.any():
+            scores[done] = -float("inf")
+            scores[done, self.eos_token_id] = 0
+        return scores
+
+
+class BeamFollowingScorer:
+    """
+    BeamScorer whose `process` also reorders the logits processors that track
+    their hypotheses (the constraint, the score accumulator) with the beams
+    each step selects, as the past keys/values are reordered
+    """
+
+    def __init__(self, beam_scorer, processors):
+        self.beam_scorer = beam_scorer
+        self.processors = processors
+
+    def __getattr__(self, name):
+        return getattr(self.beam_scorer, name)
+
+    def process(self, *args, **kwargs):
+        beam_outputs = self.beam_scorer.process(*args, **kwargs)
+        for processor in self.processors:
+            processor.reorder(beam_outputs["next_beam_indices"])
+        return beam_outputs
 
 
 add_start_docstrings("""T5 Model with a `language modeling` head on top. """, T5_START_DOCSTRING)
@@ -107,9 +311,10 @@ add_start_docstrings("""T5 Model with a `language modeling` head on top. """, T5
 class MyT5ForConditionalGeneration(T5PreTrainedModel):
     authorized_missing_keys = [r"encoder\.embed_tokens\.weight", r"decoder\.embed_tokens\.weight", r"lm_head\.weight"] 
 
-    def __init__(self, config, head):
+    def __init__(self, config, head, pooling=None):
         super().__init__(config)
         self.model_dim = config.d_model
+        self.set_pooling(pooling or getattr(config, "pooling", "fixed"))
 
         self.shared = nn.Embedding(config.vocab_size, config.d_model).to(_device)
 
@@ -131,16 +336,35 @@ class MyT5ForConditionalGeneration(T5PreTrainedModel):
 
         self.lm_head = nn.Linear(config.d_model, config.vocab_size, bias=False).to(_device)
 
+        self._extra_logits_processors = None
+        self.event_description_cache = EventDescriptionCache()
 
         self.init_weights()
 
+    def set_pooling(self, pooling):
+        """
+        fixed: positional pooling over inputs padded to exactly 250/100 tokens
+        masked: the same weights over the unpadded positions only, so inputs can
+        be padded to any length up to 250/100. Both modes share the parameters,
+        but not their outputs: masked drops the pooling weights of the padded
+        positions and the cross-attention to them, so a checkpoint trained with
+        one has to be fine-tuned after switching to the other.
+        """
+        if pooling not in ("fixed", "masked"):
+            raise ValueError(f"Unknown pooling {pooling}, expected 'fixed' or 'masked'")
+        self.pooling = pooling
+        self.config.pooling = pooling
+
     def get_input_embeddings(self):
         return self.shared
 
     def set_input_embeddings(self, new_embeddings):
         self.shared = new_embeddings.to(_device)
-        self.encoder.set_input_embeddings(new_embeddings).to(_device)
-        self.decoder.set_input_embeddings(new_embeddings).to(_device)
+        self.encoder.set_input_embeddings(self.shared)
+        self.decoder.set_input_embeddings(self.shared)
+
+    def set_output_embeddings(self, new_embeddings):
+        self.lm_head = new_embeddings.to(_device)
 
     def get_output_embeddings(self):
         return self.lm_head
@@ -151,6 +375,60 @@ class MyT5ForConditionalGeneration(T5PreTrainedModel):
     def get_decoder(self):
         return self.decoder
 
+    def encode_event_description(
+        self,
+        event_description_ids,
+        event_description_mask,
+        output_attentions=None,
+        output_hidden_states=None,
+        return_dict=True,
+    ):
+        """
+        Encode the event descriptions, through the cache when no gradient is needed
+        """
+        if not (torch.is_grad_enabled() or self.training or output_attentions or output_hidden_states):
+            return self.event_description_cache.encode(
+                self.encoder, event_description_ids, event_description_mask,
+                keep_padding=self.pooling == "fixed")
+        return self.encoder(
+            input_ids=event_description_ids, 
+            attention_mask=event_description_mask, 
+            inputs_embeds=None, 
+            head_mask=None, 
+            output_attentions=output_attentions, 
+            output_hidden_states=output_hidden_states, 
+            return_dict=return_dict, 
+        )
+
+    @staticmethod
+    def masked_pool(linear, hidden_states, mask=None):
+        """
+        Positional pooling with the leading weights of `linear`, skipping padding
+        """
+        length = hidden_states.size(1)
+        if length > linear.in_features:
+            raise ValueError(f"Pooling supports at most {linear.in_features} positions, got {length}")
+        weight = linear.weight if isinstance(linear, nn.Linear) else linear.weight().dequantize()
+        weight = weight[:, :length].unsqueeze(0)
+        if mask is not None:
+            weight = weight * mask.unsqueeze(1).to(weight.dtype)
+        return weight @ hidden_states
+
+    def event_cross_attention(self, hidden_states, hidden_states_event, attention_mask=None, event_description_mask=None):
+        """
+        Summary vector of the sentence and the event description, added to every decoder position
+        """
+        if self.pooling == "masked":
+            cls_event = self.masked_pool(self.linear_event, hidden_states_event, event_description_mask)
+            cls_sent = self.masked_pool(self.linear_sent, hidden_states, attention_mask)
+            return self.cross_attention_event.forward_pair(
+                hidden_states, cls_event, hidden_states_event, cls_sent, attention_mask, event_description_mask)
+        hidden_states_event_convert = hidden_states_event.transpose(1, 2) 
+        hidden_states_convert = hidden_states.transpose(1, 2) 
+        cls_event = self.linear_event(hidden_states_event_convert).transpose(2, 1) 
+        cls_sent = self.linear_sent(hidden_states_convert).transpose(2, 1) 
+        return self.cross_attention_event.forward_pair(hidden_states, cls_event, hidden_states_event, cls_sent)
+
     @add_start_docstrings_to_model_forward(T5_INPUTS_DOCSTRING)
     @replace_return_docstrings(output_type=Seq2SeqLMOutput, config_class=_CONFIG_FOR_DOC)
     def forward(
@@ -226,18 +504,14 @@ class MyT5ForConditionalGeneration(T5PreTrainedModel):
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
 
-        if encoder_outputs_event_description is None:
-
-            if event_description_ids is not None and event_description_mask is not None:
-                encoder_outputs_event_description = self.encoder(
-                    input_ids=event_description_ids, 
-                    attention_mask=event_description_mask, 
-                    inputs_embeds=None, 
-                    head_mask=None, 
-                    output_attentions=output_attentions, 
-                    output_hidden_states=output_hidden_states, 
-                    return_dict=return_dict, 
-                )  
+        if encoder_outputs_event_description is None and event_description_ids is not None and event_description_mask is not None:
+            encoder_outputs_event_description = self.encode_event_description(
+                event_description_ids, 
+                event_description_mask, 
+                output_attentions=output_attentions, 
+                output_hidden_states=output_hidden_states, 
+                return_dict=return_dict, 
+            )
         if encoder_outputs is None:
             encoder_outputs = self.encoder(
                 input_ids=input_ids, 
@@ -260,12 +534,9 @@ class MyT5ForConditionalGeneration(T5PreTrainedModel):
         hidden_states = encoder_outputs[0] 
         
         if cross_attn_cls is None:
-            hidden_states_event = encoder_outputs_event_description["last_hidden_state"]
-            hidden_states_event_convert = hidden_states_event.transpose(1, 2) 
-            hidden_states_convert = hidden_states.transpose(1, 2) 
-            cls_event = self.linear_event(hidden_states_event_convert).transpose(2, 1) 
-            cls_sent = self.linear_sent(hidden_states_convert).transpose(2, 1) 
-            cross_attn_cls = self.cross_attention_event(hidden_states, cls_event) + self.cross_attention_event(hidden_states_event, cls_sent) 
+            cross_attn_cls = self.event_cross_attention(
+                hidden_states, encoder_outputs_event_description["last_hidden_state"],
+                attention_mask, event_description_mask)
 
 
 
@@ -314,6 +585,31 @@ class MyT5ForConditionalGeneration(T5PreTrainedModel):
             encoder_attentions=encoder_outputs.attentions, 
         )
 
+    def generate(self, *args, logits_processor=None, **kwargs):
+        """
+        `generate` accepting extra logits processors, applied after the default ones
+        """
+        self._extra_logits_processors = logits_processor
+        try:
+            return super().generate(*args, **kwargs)
+        finally:
+            self._extra_logits_processors = None
+
+    def _get_logits_processor(self, *args, **kwargs):
+        processors = super()._get_logits_processor(*args, **kwargs)
+        if self._extra_logits_processors is not None:
+            processors.extend(self._extra_logits_processors)
+        return processors
+
+    def beam_search(self, input_ids, beam_scorer, logits_processor=None, **kwargs):
+        """
+        Beam search of generate, the processors with a `reorder` following the beams
+        """
+        processors = [processor for processor in logits_processor or [] if hasattr(processor, "reorder")]
+        if processors:
+            beam_scorer = BeamFollowingScorer(beam_scorer, processors)
+        return super().beam_search(input_ids, beam_scorer, logits_processor=logits_processor, **kwargs)
+
     def prepare_inputs_for_generation(
         self, input_ids, past=None, attention_mask=None, use_cache=None, encoder_outputs=None, 
         event_description_ids=None, event_description_mask=None, encoder_outputs_event_description=None, cross_attn_cls=None, **kwargs
@@ -340,11 +636,12 @@ class MyT5ForConditionalGeneration(T5PreTrainedModel):
 
         reordered_decoder_past = ()
         for layer_past_states in past:
-            reordered_layer_past_states = ()
-            for layer_past_state in layer_past_states:
-                reordered_layer_past_states = reordered_layer_past_states + (
-                    layer_past_state.index_select(0, beam_idx),
-                )
+            # beams only move within their example, whose beams share the same
+            # cross-attention keys/values: only the self-attention ones are gathered
+            reordered_layer_past_states = tuple(
+                layer_past_state.index_select(0, beam_idx)
+                for layer_past_state in layer_past_states[:2]
+            ) + tuple(layer_past_states[2:])
 
             assert reordered_layer_past_states[0].shape == layer_past_states[0].shape
             assert len(reordered_layer_past_states) == len(layer_past_states)
@@ -364,4 +661,24 @@ class MyT5ForConditionalGeneration(T5PreTrainedModel):
                 if not (argument.startswith("decoder_") or argument.startswith("cross_attn") or argument.startswith("event_"))
             }
             model_kwargs["encoder_outputs"]: ModelOutput = encoder(input_ids, return_dict=True, **encoder_kwargs)
-        return model_kwargs
\ No newline at end of file
+        # the event summary does not depend on the decoder, compute it once for all steps
+        event_description_ids = model_kwargs.pop("event_description_ids", None)
+        event_description_mask = model_kwargs.pop("event_description_mask", None)
+        encoder_outputs_event_description = model_kwargs.pop("encoder_outputs_event_description", None)
+        if model_kwargs.get("cross_attn_cls") is None:
+            if encoder_outputs_event_description is None:
+                encoder_outputs_event_description = self.encode_event_description(
+                    event_description_ids, event_description_mask)
+            model_kwargs["cross_attn_cls"] = self.event_cross_attention(
+                model_kwargs["encoder_outputs"].last_hidden_state,
+                encoder_outputs_event_description["last_hidden_state"],
+                model_kwargs.get("attention_mask"),
+                event_description_mask,
+            )
+        return model_kwargs
+
+    @staticmethod
+    def _expand_inputs_for_generation(input_ids, expand_size=1, cross_attn_cls=None, **model_kwargs):
+        if cross_attn_cls is not None:
+            model_kwargs["cross_attn_cls"] = cross_attn_cls.repeat_interleave(expand_size, dim=0)
+        return T5PreTrainedModel._expand_inputs_for_generation(input_ids, expand_size=expand_size, **model_kwargs)
\ No newline at end of file
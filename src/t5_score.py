@@ -348,11 +348,12 @@ class MyT5ForConditionalGenerationScore(T5PreTrainedModel):
 
         reordered_decoder_past = ()
         for layer_past_states in past:
-            reordered_layer_past_states = ()
-            for layer_past_state in layer_past_states:
-                reordered_layer_past_states = reordered_layer_past_states + (
-                    layer_past_state.index_select(0, beam_idx),
-                )
+            # beams only move within their example, whose beams share the same
+            # cross-attention keys/values: only the self-attention ones are gathered
+            reordered_layer_past_states = tuple(
+                layer_past_state.index_select(0, beam_idx)
+                for layer_past_state in layer_past_states[:2]
+            ) + tuple(layer_past_states[2:])
 
             assert reordered_layer_past_states[0].shape == layer_past_states[0].shape
             assert len(reordered_layer_past_states) == len(layer_past_states)
@@ -0,0 +1,190 @@
+import argparse
+import os
+from collections import Counter
+
+import torch
+from torch import nn
+from sentencepiece import sentencepiece_model_pb2
+from transformers import T5Tokenizer
+
+from t5 import MyT5ForConditionalGeneration
+from const import (cate_list_eae, force_words_eae, ere_event_description_dict,
+                   ere_event_type_argument_role_dict)
+from constrained_decoding import SPACE_ID, TO_PIECES
+from data_utils import read_line_examples_from_json_file
+
+MARKERS = ["[T]", "[/T]", "[A]", "[R]", "[SSEP]", "null"]
+
+
+def init_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path",
+                        required=True,
+                        type=str,
+                        help='checkpoint saved by save_pretrained, with its tokenizer, e.g. <output_dir>/final')
+    parser.add_argument("--output_dir", required=True, type=str)
+    parser.add_argument("--data_path", default="../data/", type=str)
+    parser.add_argument("--task", default='eae', type=str)
+    parser.add_argument("--dataset", default='ere-en', type=str)
+    parser.add_argument("--head", default=4, type=int)
+    parser.add_argument("--lowercase", action='store_true')
+    parser.add_argument("--vocab_splits",
+                        default=["train"],
+                        nargs="+",
+                        help='splits whose tokens are kept')
+    parser.add_argument("--heldout_splits",
+                        default=["dev", "test"],
+                        nargs="+",
+                        help='splits, or paths of json files, to report the out-of-vocabulary rate on')
+    parser.add_argument("--min_count",
+                        default=1,
+                        type=int,
+                        help='occurrences of a corpus token needed to keep it')
+    return parser.parse_args()
+
+
+def corpus_texts(args, split):
+    """
+    Sentences of a split, as the model reads them, and their argument words
+    """
+    data_path = split if split.endswith(".json") else os.path.join(
+        args.data_path, args.task, args.dataset, f"{split}.json")
+    _, _, sents, labels = read_line_examples_from_json_file(
+        data_path, args.task, args.dataset, args.lowercase)
+    texts = [" ".join(sent) for sent in sents]
+    for events in labels:
+        for event in events:
+            texts.append(event["trigger"]["words"])
+            texts.extend(arg["words"] for arg in event["arguments"])
+    return texts
+
+
+def ontology_texts(args):
+    """
+    Markers, event types, roles and event descriptions that inputs and
+    targets are built from
+    """
+    texts = MARKERS + cate_list_eae[args.dataset] + force_words_eae[args.task][args.dataset]
+    for event_type, roles in ere_event_type_argument_role_dict.items():
+        texts.append(event_type)
+        texts.extend(roles)
+    texts.extend(ere_event_description_dict.values())
+    return texts
+
+
+def count_tokens(tokenizer, texts):
+    counts = Counter()
+    for text in texts:
+        counts.update(tokenizer.encode(text, add_special_tokens=False))
+    return counts
+
+
+def build_vocab(tokenizer, corpus_counts, ontology_counts, min_count=1):
+    """
+    Sorted ids kept: the special tokens and '▁', every single character piece
+    so that any text still tokenizes without unk, the pieces of the markers,
+    the ontology tokens and the corpus tokens seen `min_count` times
+    """
+    kept = set(tokenizer.all_special_ids) | {SPACE_ID}
+    kept.update(i for i in range(tokenizer.sp_model.get_piece_size())
+                if len(tokenizer.sp_model.id_to_piece(i).lstrip("▁")) <= 1)
+    for pieces in TO_PIECES.values():
+        kept.update(tokenizer.convert_tokens_to_ids(pieces))
+    kept.update(ontology_counts)
+    kept.update(i for i, count in corpus_counts.items() if count >= min_count)
+    # extra ids of the t5 tokenizer are not sentencepiece pieces
+    return sorted(i for i in kept if i < tokenizer.sp_model.get_piece_size())
+
+
+def trim_tokenizer(tokenizer, kept, output_dir):
+    """
+    Sentencepiece model restricted to the `kept` pieces, in their order, so
+    that piece `kept[i]` gets id i, saved as a T5Tokenizer in `output_dir`
+    """
+    proto = sentencepiece_model_pb2.ModelProto()
+    with open(tokenizer.vocab_file, "rb") as f:
+        proto.ParseFromString(f.read())
+    pieces = [proto.pieces[i] for i in kept]
+    del proto.pieces[:]
+    proto.pieces.extend(pieces)
+    proto.trainer_spec.vocab_size = len(pieces)
+    os.makedirs(output_dir, exist_ok=True)
+    vocab_file = os.path.join(output_dir, "spiece.model")
+    with open(vocab_file, "wb") as f:
+        f.write(proto.SerializeToString())
+    trimmed = T5Tokenizer(vocab_file, extra_ids=0)
+    trimmed.save_pretrained(output_dir)
+    return trimmed
+
+
+def trim_model(model, kept):
+    """
+    Keep the rows of the `kept` ids of the shared embedding and lm_head
+    """
+    index = torch.tensor(kept, device=model.shared.weight.device)
+    shared = nn.Embedding(len(kept), model.config.d_model)
+    shared.weight.data = model.shared.weight.data[index].clone()
+    lm_head = nn.Linear(model.config.d_model, len(kept), bias=False)
+    lm_head.weight.data = model.lm_head.weight.data[index].clone()
+    model.set_input_embeddings(shared)
+    model.set_output_embeddings(lm_head)
+    model.config.vocab_size = len(kept)
+    if model.config.tie_word_embeddings:
+        model.tie_weights()
+    return model
+
+
+def coverage_report(tokenizer, trimmed, kept, texts):
+    """
+    Out-of-vocabulary rate of `texts`: tokens of the full vocabulary the
+    trimmed one lacks, texts with any of them, and the tokens and unk the
+    trimmed tokenizer splits them into instead
+    """
+    kept = set(kept)
+    tokens = oov = oov_texts = trimmed_tokens = unk = 0
+    for text in texts:
+        ids = tokenizer.encode(text, add_special_tokens=False)
+        missing = sum(i not in kept for i in ids)
+        tokens += len(ids)
+        oov += missing
+        oov_texts += missing > 0
+        trimmed_ids = trimmed.encode(text, add_special_tokens=False)
+        trimmed_tokens += len(trimmed_ids)
+        unk += trimmed_ids.count(trimmed.unk_token_id)
+    return {
+        "texts": len(texts),
+        "tokens": tokens,
+        "oov_tokens": oov,
+        "oov_rate": oov / max(tokens, 1),
+        "oov_text_rate": oov_texts / max(len(texts), 1),
+        "token_increase": trimmed_tokens / max(tokens, 1) - 1,
+        "unk_tokens": unk,
+    }
+
+
+def main():
+    args = init_args()
+    tokenizer = T5Tokenizer.from_pretrained(args.model_path)
+    corpus_counts = Counter()
+    for split in args.vocab_splits:
+        corpus_counts.update(count_tokens(tokenizer, corpus_texts(args, split)))
+    kept = build_vocab(tokenizer, corpus_counts,
+                       count_tokens(tokenizer, ontology_texts(args)),
+                       args.min_count)
+    print(f"Vocabulary: {len(kept)} of {len(tokenizer)} tokens kept")
+
+    trimmed = trim_tokenizer(tokenizer, kept, args.output_dir)
+    model = MyT5ForConditionalGeneration.from_pretrained(args.model_path,
+                                                         head=args.head)
+    trim_model(model, kept).save_pretrained(args.output_dir)
+    print(f"Compact checkpoint saved to {args.output_dir}")
+
+    for split in args.heldout_splits:
+        report = coverage_report(tokenizer, trimmed, kept, corpus_texts(args, split))
+        print(f"{split}: " + ", ".join(
+            f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}"
+            for key, value in report.items()))
+
+
+if __name__ == '__main__':
+    main()